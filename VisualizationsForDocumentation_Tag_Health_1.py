@@ -1,9 +1,21 @@
 import pandas as pd
-import ast, os, dash
+import os, threading, time, uuid, dash
+from functools import partial
 import plotly.graph_objs as go
 from dash import Dash, dcc, html, Input, Output, State
 import dash_bootstrap_components as dbc
 from datetime import datetime
+from tag_health_loader import (build_tag_frame, build_health_frame, append_rows, TagTail, add_calendar_columns,
+                               stream_tag_rollups, rollup_tag_frame, merge_rollups,
+                               label_calendar, WEEKDAY_NAMES, is_sharded_source, load_tag_shards,
+                               split_quarantine, DeviceTimeIndex, trace_allocations, health_hourly_rollups,
+                               with_fleet_partition, health_means, health_means_from_sums, ALL_DEVICES,
+                               ROLLUP_COLUMNS, HEALTH_METRICS, HEALTH_SUM_COLUMNS)
+from tag_health_cache import cached_frame
+from tag_health_store import SessionStore, SqliteTagStore, ingest_tag_csv, sketch_stored_rows
+from tag_health_delta import SessionRanges, range_days, hourly_rows, TAG_SUMMED
+from tag_health_sketch import (tag_distinct_sketches, merge_tag_distinct_sketches, health_quantile_sketches,
+                               health_percentiles)
 
 
 kpi_card_style = {
@@ -21,40 +33,179 @@ kpi_card_style = {
 }
 
 
-# Load CSV
-csv_path_tag = os.path.join(os.path.dirname(__file__), "data", "tag_data_from_customerdevicedata_table.csv")
+# Load CSV (derived frames are cached next to the source, see tag_health_cache)
+# TAG_CSV may point at another export, a directory of daily shards or a glob (data/exports/*.csv)
+csv_path_tag = os.environ.get("TAG_CSV") or os.path.join(os.path.dirname(__file__), "data", "tag_data_from_customerdevicedata_table.csv")
 csv_path_health = os.path.join(os.path.dirname(__file__), "data", "device_management_healthdata.csv")
-df = pd.read_csv(csv_path_tag, parse_dates=["created_at", "updated_at"])
-df_health = pd.read_csv(csv_path_health, parse_dates=["created_at", "updated_at"])
-
-# Parse JSON
-def parse_json(val):
-    try:
-        return ast.literal_eval(val) if isinstance(val, str) else val
-    except Exception:
-        return {}
-
-#for df
-df["json_1"] = df["json_1"].apply(parse_json)
-df["json_timestamp"] = df["json_1"].apply(lambda x: pd.to_datetime(x.get("timestamp"), utc=True) if isinstance(x, dict) and x.get("timestamp") else pd.NaT)
-df["year"] = df["json_timestamp"].dt.year.astype("Int64").astype(str)
-df["month"] = df["json_timestamp"].dt.strftime('%b')  # Jan, Feb, etc.
-df["weekday"] = df["json_timestamp"].dt.day_name()    # Monday, Tuesday, etc.
-df["hour"] = df["json_timestamp"].dt.hour.astype("Int64").astype(str).str.zfill(2)
-df["date"] = df["json_timestamp"].dt.date
-
-
-
-
-#for df_health
-df_health["timestamp"] = pd.to_datetime(
-    df_health["timestamp"], errors="coerce", utc=True
-)
-df_health["year"] = df_health["timestamp"].dt.year.astype("Int64").astype(str)
-df_health["month"] = df_health["timestamp"].dt.strftime('%b')  # Jan, Feb, etc.
-df_health["weekday"] = df_health["timestamp"].dt.day_name()    # Monday, Tuesday, etc.
-df_health["hour"] = df_health["timestamp"].dt.hour.astype("Int64").astype(str).str.zfill(2)
-df_health["date"] = df_health["timestamp"].dt.date
+store_path_tag = os.path.join(os.path.dirname(__file__), "data", "tag_sessions.bin")
+sqlite_path_tag = os.path.join(os.path.dirname(__file__), "data", "tag_sessions.sqlite")
+
+
+# A dataset that is loaded the first time a tab asks for it. get() runs `load`
+# at most once at a time (concurrent callbacks wait for the same load) and
+# returns its result; a failed load is remembered in `error` and retried on
+# the next get(), e.g. once a missing export has been copied in.
+class LazyDataset:
+    def __init__(self, name, load):
+        self.name = name
+        self.load = load
+        self.state = "not loaded"  # -> "loading" -> "ready" / "failed"
+        self.error = None
+        self.value = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.state == "ready":
+            return self.value
+        with self.lock:
+            if self.state != "ready":
+                self.state = "loading"
+                try:
+                    self.value = self.load()
+                except Exception as e:
+                    self.state, self.error = "failed", e
+                    print(f"Could not load {self.name} data: {e}")
+                    raise
+                self.state, self.error = "ready", None
+        return self.value
+
+    def status(self):
+        return f"{self.name}: {self.state}" + (f" ({self.error})" if self.state == "failed" else "")
+
+
+# Each peak KPI card pages through at most PEAK_HISTORY of the most recent peak readings
+PEAK_HISTORY = 10
+
+
+# The health frame as a DeviceTimeIndex ("index", for the peak KPIs), its
+# hourly rollups of every device and the fleet ("hourly", for the calendar
+# means) and per (device, hour) quantile sketches of every metric
+# ("quantiles") for the percentile charts
+def load_health_data():
+    health = DeviceTimeIndex(cached_frame(csv_path_health, build_health_frame), "timestamp",
+                             max_columns=HEALTH_METRICS, peak_k=PEAK_HISTORY)
+    return {
+        "index": health,
+        "hourly": DeviceTimeIndex(health_hourly_rollups(health.df), "hour_bucket"),
+        "quantiles": health_quantile_sketches(health.df, HEALTH_METRICS),
+    }
+
+
+health_dataset = LazyDataset("Health", load_health_data)
+
+# Current version of the tag data (frame + anything derived from it).
+# Callbacks read `tag_data` once per request; the tail thread builds a new
+# dict and swaps the reference, so a request never sees a half-updated version.
+# TAG_SOURCE=rollup streams the export into hourly rollups instead of keeping
+# every row in memory (for exports larger than RAM); TAG_SOURCE=store keeps the
+# session history in the memory-mapped store at store_path_tag and only pages
+# in the requested date range; TAG_SOURCE=sqlite does the same with indexed
+# range queries against the SQLite database at sqlite_path_tag.
+# Sharded sources are parsed in a process pool (each shard cached on its own)
+# and have no tail reader: new shards are picked up on restart.
+def load_tag_data():
+    if is_sharded_source(csv_path_tag):
+        df = load_tag_shards(csv_path_tag, partial(cached_frame, build=build_tag_frame))
+        return frame_tag_data(df), None
+    if os.environ.get("TAG_SOURCE") in ("store", "sqlite"):
+        if os.environ["TAG_SOURCE"] == "sqlite":
+            store = SqliteTagStore(sqlite_path_tag)
+        else:
+            store = SessionStore(store_path_tag)
+        if len(store) == 0:
+            ingest_tag_csv(store, csv_path_tag)
+        elif store.distinct is None:
+            sketch_stored_rows(store, csv_path_tag)
+        offset = store.meta.get("source_size", 0)
+        if offset > os.path.getsize(csv_path_tag):
+            offset = 0  # a new export file, ids still continue from the store
+        return {"store": store}, TagTail(csv_path_tag, offset=offset, last_id=store.meta.get("last_id"))
+    if os.environ.get("TAG_SOURCE") == "rollup":
+        rollups, distinct = stream_tag_rollups(csv_path_tag)
+        return {"rollups": tag_rollup_index(rollups), "distinct": distinct}, TagTail(csv_path_tag, rollups)
+    df = cached_frame(csv_path_tag, build_tag_frame)
+    return frame_tag_data(df), TagTail(csv_path_tag, df)
+
+
+# Rows that fail payload validation go to a quarantine frame, the callbacks
+# only ever see the clean rows. The Tag charts and KPIs are re-aggregated from
+# the (device, hour bucket) rollups built here, so a date change costs one
+# pass over the hours in range instead of over the raw sessions. "rollups" is
+# a DeviceTimeIndex over them, so the range itself is found by binary search;
+# they carry the fleet partition (ALL_DEVICES), so every device and "all
+# devices" are lookups into the same one-pass (device, hour) group-by.
+# Distinct sessions and tags are not additive over hours, "distinct" holds
+# mergeable sketches of both per (device, hour) instead (see DistinctSketches).
+# The parsed rows themselves are not kept, no callback reads them.
+def frame_tag_data(df):
+    df, quarantine = split_quarantine(df)
+    rollups = tag_rollup_index(rollup_tag_frame(df))
+    return {"quarantine": quarantine, "rollups": rollups, "distinct": tag_distinct_sketches(df)}
+
+
+# Set by start_tag_data() the first time the Tag tab (or the date range) needs them
+tag_data, tag_tail = None, None
+tag_tail_lock = threading.Lock()
+
+
+def extend_tag_data(data, new_rows):
+    new_rows, rejected = split_quarantine(new_rows)
+    if "store" in data:
+        data["store"].append(new_rows)  # readers only see whole records
+        return data
+    rollups = tag_rollup_index(merge_rollups(data["rollups"].df, rollup_tag_frame(new_rows)))
+    distinct = merge_tag_distinct_sketches(data["distinct"], tag_distinct_sketches(new_rows))
+    if "quarantine" not in data:
+        return {**data, "rollups": rollups, "distinct": distinct}
+    return {**data, "rollups": rollups, "distinct": distinct, "quarantine": append_rows(data["quarantine"], rejected)}
+
+
+def tag_rollup_index(rollups):
+    return DeviceTimeIndex(with_fleet_partition(rollups, "hour_bucket", ROLLUP_COLUMNS), "hour_bucket")
+
+
+def tag_time_range(data):
+    if "store" in data:
+        return data["store"].time_range()
+    return data["rollups"].time_range()
+
+
+# Pick up rows the DB export appended since the last check
+def refresh_tag_data():
+    global tag_data, tag_tail
+    if tag_tail is None:
+        return
+    with tag_tail_lock:
+        if tag_tail.shrunk():
+            tag_data, tag_tail = load_tag_data()
+            return
+        new_rows = tag_tail.read_new_rows()
+        if new_rows is not None:
+            tag_data = extend_tag_data(tag_data, new_rows)
+            if "store" in tag_data:
+                tag_data["store"].mark_ingested(tag_tail.offset, tag_tail.last_id)
+            print(f"tag data: appended {len(new_rows)} rows (last id {tag_tail.last_id})")
+
+
+def tail_tag_data(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            refresh_tag_data()
+        except Exception as e:
+            print(f"Error while reading appended tag rows: {e}")
+
+
+def start_tag_data():
+    global tag_data, tag_tail
+    tag_data, tag_tail = load_tag_data()
+    # Incremental ingestion mode: TAG_TAIL_SECONDS=300 polls the export every 5 minutes
+    if os.environ.get("TAG_TAIL_SECONDS"):
+        threading.Thread(target=tail_tag_data, args=(float(os.environ["TAG_TAIL_SECONDS"]),), daemon=True).start()
+
+
+tag_dataset = LazyDataset("Tag", start_tag_data)
+datasets = {"Tag": tag_dataset, "Health": health_dataset}
 
 # App
 app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
@@ -62,6 +213,7 @@ app.title = "RFID Dashboard"
 
 # application layout
 app.layout = html.Div([
+    dcc.Store(id="session-id", storage_type="session"),
     html.H2("RFID Device Dashboard", style={"textAlign": "center", "marginTop": "20px"}),
     dcc.Tabs(id="tabs", value="Tag", children=[
         dcc.Tab(label="Tag", value="Tag"),
@@ -76,10 +228,18 @@ app.layout = html.Div([
         dcc.DatePickerRange(
             id="date-range",
             display_format="YYYY-MM-DD",
-            start_date=df["json_timestamp"].min().date(),
-            end_date=df["json_timestamp"].max().date(),
             style={"marginBottom": "20px"}
         ),
+        html.Label("Select Device:"),
+        dcc.Dropdown(
+            id="device",
+            options=[{"label": "All devices", "value": ALL_DEVICES}],
+            value=ALL_DEVICES,
+            clearable=False,
+            style={"marginBottom": "20px"}
+        ),
+        html.Div(id="data-status", style={"fontSize": "12px", "marginBottom": "10px"}),
+        dcc.Interval(id="data-status-interval", interval=2000),
 
         # Unified KPI block container
         html.Div(id="kpi-blocks", style={
@@ -118,45 +278,218 @@ app.layout = html.Div([
     Output("tab-content", "children"),
     Input("tabs", "value"),
     Input("date-range", "start_date"),
-    Input("date-range", "end_date")
+    Input("date-range", "end_date"),
+    Input("device", "value"),
+    State("session-id", "data")
 )
-def render_tab_content(tab, start_date, end_date):
+def render_tab_content(tab, start_date, end_date, device=ALL_DEVICES, session_id=None):
+    # a dataset that fails to load never gets a date range, so report it first
+    try:
+        datasets[tab].get()
+    except Exception as e:
+        return [], html.Div(f"{tab} data is not available: {e}", style={"padding": "20px"})
+    if start_date is None or end_date is None:
+        return dash.no_update, dash.no_update  # fill_date_range sets the range first
     if tab == "Tag":
         # Existing logic for tag KPIs and charts
-        return update_visuals_for_Tag(start_date, end_date)
+        return update_visuals_for_Tag(start_date, end_date, device, session_id)
     elif tab == "Health":
-        return update_visuals_for_Health(start_date, end_date)
-def update_visuals_for_Tag(start_date, end_date):
-    filtered = df.copy()
-    filtered_health = df_health.copy()
+        return update_visuals_for_Health(start_date, end_date, device, session_id)
 
-    # if device_id:
-    #     filtered = filtered[filtered["device_id_id"] == device_id]
 
-    filtered = filtered[filtered["device_id_id"] == 1]
-    
+# Browser-session id, the key for the per-session range aggregates below
+@app.callback(
+    Output("session-id", "data"),
+    Input("tabs", "value"),
+    State("session-id", "data")
+)
+def assign_session_id(tab, session_id):
+    return dash.no_update if session_id else uuid.uuid4().hex
+
+
+# Aggregates of each session's last date range per tab; when the picker moves
+# only the days that entered / left the range are computed (see DeltaRange).
+session_ranges = SessionRanges()
+
+
+# The date range starts out empty and is set to the full range of the first
+# tab's dataset, so only that dataset is loaded on the first page view.
+@app.callback(
+    Output("date-range", "start_date"),
+    Output("date-range", "end_date"),
+    Input("tabs", "value"),
+    State("date-range", "start_date"),
+    State("date-range", "end_date")
+)
+def fill_date_range(tab, start_date, end_date):
+    if start_date is not None and end_date is not None:
+        return dash.no_update, dash.no_update
+    try:
+        if tab == "Tag":
+            tag_dataset.get()
+            start, end = tag_time_range(tag_data)
+        else:
+            start, end = health_dataset.get()["index"].time_range()
+    except Exception:
+        return dash.no_update, dash.no_update  # render_tab_content shows the error
+    if pd.isna(start):
+        return dash.no_update, dash.no_update
+    return start.date(), end.date()
+
+
+# The device choices are the devices of the current tab's dataset; a device
+# the dataset does not have falls back to all devices.
+@app.callback(
+    Output("device", "options"),
+    Output("device", "value"),
+    Input("tabs", "value"),
+    Input("date-range", "start_date"),
+    State("device", "value")
+)
+def fill_device_options(tab, start_date, device):
+    if start_date is None:
+        return dash.no_update, dash.no_update  # the dataset is still loading
+    try:
+        if tab == "Tag":
+            tag_dataset.get()
+            data = tag_data
+            devices = data["store"].devices() if "store" in data else data["rollups"].devices()
+        else:
+            devices = health_dataset.get()["index"].devices()
+    except Exception:
+        return dash.no_update, dash.no_update
+    options = [{"label": "All devices", "value": ALL_DEVICES}]
+    options += [{"label": f"Device {d}", "value": d} for d in devices]
+    return options, device if device in devices else ALL_DEVICES
+
+
+# None (every device) for the fleet, else [device], for the sketch queries
+def sketch_devices(device):
+    return None if device == ALL_DEVICES else [device]
+
+
+# Polls only while a dataset is loading (or the open tab's has not started
+# yet); switching tabs re-enables it for a dataset that still has to load.
+@app.callback(
+    Output("data-status", "children"),
+    Output("data-status-interval", "disabled"),
+    Input("data-status-interval", "n_intervals"),
+    Input("tabs", "value")
+)
+def show_data_status(n_intervals, tab):
+    waiting = any(dataset.state == "loading" for dataset in datasets.values()) or datasets[tab].state == "not loaded"
+    return " · ".join(dataset.status() for dataset in datasets.values()), not waiting
+
+
+def update_visuals_for_Tag(start_date, end_date, device=ALL_DEVICES, session_id=None):
+    data = tag_data  # one consistent version for the whole request
 
     start_dt = pd.to_datetime(start_date, utc=True)
     end_dt = pd.to_datetime(end_date, utc=True) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
 
-    filtered = filtered[(filtered["json_timestamp"] >= start_dt) & (filtered["json_timestamp"] <= end_dt)]
-    # KPIs
-    total_tag_reads = 0
-    for js in filtered["json_1"]:
-        if isinstance(js, dict):
-            count = js.get("count")
-            if count not in [None, '', 'null']:
-                try:
-                    total_tag_reads += int(count)
-                except:
-                    total_tag_reads += len(js.get("tags", []))
-            else:
-                total_tag_reads += len(js.get("tags", []))
-
-    # total_devices = filtered["device_id_id"].nunique()
-    total_sessions = filtered["int_1"].nunique()
-    successes = (filtered["char_1"] == "success").sum()
-    failures = (filtered["char_1"] == "failed").sum()
+    aggregates = None
+    if "store" in data:
+        page = data["store"].query(start_dt, end_dt, device=None if device == ALL_DEVICES else device)
+        rollups = tag_rollup_index(rollup_tag_frame(page, reads=page["reads"]))
+        aggregates = tag_aggregates_from_rollups(rollups, device, start_dt, end_dt)
+    elif session_id:
+        ranges = session_ranges.get(session_id, ("Tag", device), data["rollups"],
+                                    partial(hourly_rows, data["rollups"], TAG_SUMMED, device), TAG_SUMMED)
+        totals = ranges.update(*range_days(start_dt, end_dt))
+        if totals.rows():
+            aggregates = tag_aggregates_from_ranges(totals)
+    if aggregates is None:
+        aggregates = tag_aggregates_from_rollups(data["rollups"], device, start_dt, end_dt)
+    distinct = data["store"].distinct if "store" in data else data["distinct"]
+    aggregates.update(distinct_counts(distinct, sketch_devices(device), start_dt, end_dt))
+    return build_tag_visuals(**aggregates)
+
+
+# Relative standard error of estimated distinct counts; ranges with at most
+# DISTINCT_EXACT_LIMIT sketch entries are counted exactly instead
+DISTINCT_ERROR = float(os.environ.get("DISTINCT_ERROR", 0.01))
+DISTINCT_EXACT_LIMIT = int(os.environ.get("DISTINCT_EXACT_LIMIT", 1 << 16))
+
+
+# Distinct sessions and tags of `devices` (None: all) in the range, from the (device, hour) sketches
+def distinct_counts(distinct, devices, start_dt, end_dt):
+    counts = {name: sketches.count(devices, start_dt, end_dt, DISTINCT_ERROR, DISTINCT_EXACT_LIMIT)
+              for name, sketches in distinct.items()}
+    return dict(total_sessions=counts["sessions"], unique_tags=counts["tags"])
+
+
+# Key of the row with the largest `value`, None for a range without rows
+def peak_key(frame, key, value):
+    return frame.loc[frame[value].idxmax(), key] if len(frame) else None
+
+
+# tag_aggregates_from_rollups' result from a session's DeltaRange totals (a RangeTotals)
+def tag_aggregates_from_ranges(ranges):
+    def reads(name, column, label):
+        frame = ranges.frame(name)
+        return pd.DataFrame({column: frame.index.get_level_values(column).astype("int64"),
+                             label: frame["reads"].astype("int64").to_numpy()})
+
+    total = dict(zip(ranges.columns, ranges.total.astype("int64")))
+    daily = ranges.daily()
+    peak_day = daily["reads"].idxmax() if len(daily) else None
+    hours = reads("hour", "hour", "hourly_total_tag_reads")
+    yearly = reads("year", "year", "yearly_total_tag_reads")
+    monthly = reads("year_month", "month", "monthly_total_tag_reads")
+    weekday = reads("weekday", "weekday", "weekly_total_tag_reads")
+    line = ranges.hourly_points()
+
+    return dict(
+        total_tag_reads=int(total["reads"]),
+        total_sessions=int(total["sessions"]),
+        successes=int(total["successes"]),
+        failures=int(total["failures"]),
+        peak_weekdate=None if peak_day is None else peak_day.date(),
+        peak_weekday=None if peak_day is None else peak_day.day_name(),
+        peak_hour=peak_key(hours, "hour", "hourly_total_tag_reads"),
+        yearly=yearly,
+        monthly_avg=monthly.groupby("month")["monthly_total_tag_reads"].mean().reset_index(),
+        weekly_avg=weekday.groupby("weekday")["weekly_total_tag_reads"].mean().reset_index(),
+        hourly_avg=hours.groupby("hour")["hourly_total_tag_reads"].mean().reset_index(),
+        line=pd.DataFrame({"time_bin": line.index, "tag_reads": line["reads"].astype("int64").to_numpy()}),
+    )
+
+
+# Tag KPIs and chart data from the per-device hourly rollups (see rollup_tag_frame).
+# Sessions are summed per hour, so a session spanning hours counts once per hour.
+def tag_aggregates_from_rollups(rollups, device, start_dt, end_dt):
+    rows = rollups.slice(device, start_dt, end_dt)
+    # calendar keys go on a two-column projection, the shared slice is only read
+    filtered = add_calendar_columns(pd.DataFrame({"hour_bucket": rows["hour_bucket"], "reads": rows["reads"]}), "hour_bucket")
+
+    weekdates = filtered.groupby("date")["reads"].sum().reset_index(name="weekly_total_tag_reads")
+    peak_weekdate = peak_key(weekdates, "date", "weekly_total_tag_reads")
+    hours = filtered.groupby("hour")["reads"].sum().reset_index(name="hourly_total_tag_reads")
+
+    yearly = filtered.groupby("year")["reads"].sum().reset_index(name="yearly_total_tag_reads")
+    monthly = filtered.groupby(["year", "month"])["reads"].sum().reset_index(name="monthly_total_tag_reads")
+    weekday = filtered.groupby("weekday")["reads"].sum().reset_index(name="weekly_total_tag_reads")
+    grouped = filtered.groupby("hour_bucket")["reads"].sum().reset_index()
+
+    return dict(
+        total_tag_reads=int(rows["reads"].sum()),
+        total_sessions=int(rows["sessions"].sum()),
+        successes=int(rows["successes"].sum()),
+        failures=int(rows["failures"].sum()),
+        peak_weekdate=peak_weekdate,
+        peak_weekday=None if peak_weekdate is None else pd.Timestamp(peak_weekdate).day_name(),
+        peak_hour=peak_key(hours, "hour", "hourly_total_tag_reads"),
+        yearly=yearly,
+        monthly_avg=monthly.groupby("month")["monthly_total_tag_reads"].mean().reset_index(),
+        weekly_avg=weekday.groupby("weekday")["weekly_total_tag_reads"].mean().reset_index(),
+        hourly_avg=hours.groupby("hour")["hourly_total_tag_reads"].mean().reset_index(),
+        line=grouped.rename(columns={"hour_bucket": "time_bin", "reads": "tag_reads"}) if len(grouped) else None,
+    )
+
+
+def build_tag_visuals(total_tag_reads, total_sessions, successes, failures, peak_weekdate, peak_weekday,
+                      peak_hour, yearly, monthly_avg, weekly_avg, hourly_avg, line, unique_tags=None):
+    yearly, monthly_avg, weekly_avg, hourly_avg = map(label_calendar, (yearly, monthly_avg, weekly_avg, hourly_avg))
     success_rate = round((successes / (successes + failures)) * 100, 2) if (successes + failures) else 0
 
     # kpi_style = {"padding": "10px", "border": "1px solid #ccc", "borderRadius": "8px", "textAlign": "center", "background": "#f8f9fa"}
@@ -167,42 +500,21 @@ def update_visuals_for_Tag(start_date, end_date):
     else:
         rate_color = "#CB5F30"  # light red
 
-    weekdates = filtered.groupby("date").apply(
-    lambda f: sum(
-        int(js.get("count", len(js.get("tags", []))))
-        if isinstance(js := j, dict) and js.get("count") not in [None, '', 'null']
-        else len(js.get("tags", []))
-        for j in f["json_1"]
-    )
-    ).reset_index(name="weekly_total_tag_reads")  # Use this syntax when it's a Series
-
-
-    
-
-    # Get peak weekday (row with max tag reads)
-    peak_weekdate = weekdates.loc[weekdates["weekly_total_tag_reads"].idxmax(), "date"]
-
-    hours = filtered.groupby("hour").apply(lambda f: sum(
-        int(js.get("count", len(js.get("tags", [])))) if isinstance(js := j, dict) and js.get("count") not in [None, '', 'null']
-        else len(js.get("tags", []))
-        for j in f["json_1"]
-    )).reset_index(name="hourly_total_tag_reads")
-    peak_hour = hours.loc[hours["hourly_total_tag_reads"].idxmax(), "hour"]
-    peak_hour_ampm = datetime.strptime(str(peak_hour), "%H").strftime("%I %p")
-    start_hour = f"{int(peak_hour_ampm.split(' ')[0]) - 1}{peak_hour_ampm.split(' ')[1]}"# Extract hour part
-    end_hour =  f"{int(peak_hour_ampm.split(' ')[0]) + 1}{peak_hour_ampm.split(' ')[1]}"# Extract hour part
-    # print("peak_weekdate:", peak_weekdate)
-    print("peak dates:", df[df['date'] == peak_weekdate]['weekday'])
-    # print("df_weekdates:", df[df['date'] == peak_weekdate])
-
-
+    if peak_hour is None:
+        peak_day = "No data"  # no tag reads in the range
+    else:
+        peak_hour_ampm = datetime.strptime(str(peak_hour), "%H").strftime("%I %p")
+        start_hour = f"{int(peak_hour_ampm.split(' ')[0]) - 1}{peak_hour_ampm.split(' ')[1]}"# Extract hour part
+        end_hour =  f"{int(peak_hour_ampm.split(' ')[0]) + 1}{peak_hour_ampm.split(' ')[1]}"# Extract hour part
+        peak_day = f"{peak_weekdate}, {peak_weekday}, {start_hour}-{end_hour}"
 
     kpi_blocks = [
         html.Div([html.H6("Total Tag Reads"), html.H4(f"{total_tag_reads}")], style={**kpi_card_style, "backgroundColor": "#f8f9fa"}),
         html.Div([html.H6("Total Sessions"), html.H4(f"{total_sessions}")], style={**kpi_card_style, "backgroundColor": "#f8f9fa"}),
+        html.Div([html.H6("Unique Tags"), html.H4("n/a" if unique_tags is None else f"{unique_tags}")], style={**kpi_card_style, "backgroundColor": "#f8f9fa"}),
         html.Div([html.H6("Successes"), html.H4(f"{successes}")], style={**kpi_card_style, "backgroundColor": "#f8f9fa"}),
         html.Div([html.H6("Failures"), html.H4(f"{failures}")], style={**kpi_card_style, "backgroundColor": "#f8f9fa"}),
-        html.Div([html.H6("Peak Day"), html.H4(f"{peak_weekdate}, {df[df['date'] == peak_weekdate]['weekday'].iloc[0]}, {start_hour}-{end_hour}")], style={**kpi_card_style, "backgroundColor": "#f8f9fa"}),
+        html.Div([html.H6("Peak Day"), html.H4(peak_day)], style={**kpi_card_style, "backgroundColor": "#f8f9fa"}),
         # html.Div([html.H6("Peak Hour(in 24hr format)"), html.H4(f"{start_hour}-{end_hour}")], style={**kpi_card_style, "backgroundColor": "#f8f9fa"}),
 
         # Add dynamic color style for success ratepeak_temperature_value_end_hour
@@ -214,37 +526,6 @@ def update_visuals_for_Tag(start_date, end_date):
 
     
 
-    # Yearly totals
-    yearly = filtered.groupby("year").apply(lambda f: sum(
-        int(js.get("count", len(js.get("tags", [])))) if isinstance(js := j, dict) and js.get("count") not in [None, '', 'null']
-        else len(js.get("tags", []))
-        for j in f["json_1"]
-    )).reset_index(name="yearly_total_tag_reads")
-
-    # Monthly averages
-    monthly = filtered.groupby(["year", "month"]).apply(lambda f: sum(
-    int(js.get("count", len(js.get("tags", [])))) if isinstance(js := j, dict) and js.get("count") not in [None, '', 'null']
-    else len(js.get("tags", []))
-    for j in f["json_1"]
-    )).reset_index(name="monthly_total_tag_reads")
-    monthly_avg = monthly.groupby("month")["monthly_total_tag_reads"].mean().reset_index()
-
-    # Weekly averages
-    weekday = filtered.groupby("weekday").apply(lambda f: sum(
-        int(js.get("count", len(js.get("tags", [])))) if isinstance(js := j, dict) and js.get("count") not in [None, '', 'null']
-        else len(js.get("tags", []))
-        for j in f["json_1"]
-    )).reset_index(name="weekly_total_tag_reads")
-    weekly_avg = weekday.groupby("weekday")["weekly_total_tag_reads"].mean().reset_index()
-
-    # Calculate hourly averages
-    hourly = filtered.groupby("hour").apply(lambda f: sum(
-        int(js.get("count", len(js.get("tags", [])))) if isinstance(js := j, dict) and js.get("count") not in [None, '', 'null']
-        else len(js.get("tags", []))
-        for j in f["json_1"]
-    )).reset_index(name="hourly_total_tag_reads")
-    hourly_avg = hourly.groupby("hour")["hourly_total_tag_reads"].mean().reset_index()
-    
     # Chart creation
     # 1.Stacked bar for month with years
     month_fig = go.Figure()
@@ -342,23 +623,8 @@ def update_visuals_for_Tag(start_date, end_date):
                         )
 
     # 3.Line Chart
-    line_data = []
-    for _, row in filtered.iterrows():
-        js = row["json_1"]
-        ts = js.get("timestamp")
-        if ts:
-            try:
-                ts = pd.to_datetime(ts)
-                count_val = js.get("count", None)
-                count = int(count_val) if count_val not in [None, '', 'null'] else len(js.get("tags", []))
-                line_data.append({"timestamp": ts, "tag_reads": count})
-            except:
-                continue
-
-    line_df = pd.DataFrame(line_data)
-    if not line_df.empty:
-        line_df["time_bin"] = line_df["timestamp"].dt.floor("1h")
-        grouped = line_df.groupby("time_bin")["tag_reads"].sum().reset_index()
+    if line is not None:
+        grouped = line
 
         # Only show labels for top 10% tag_reads values
         threshold = grouped["tag_reads"].quantile(0.90)
@@ -523,83 +789,34 @@ def update_health_kpis(
         temp_list[temp_idx] if temp_list else "No data",
         cpu_idx, mem_idx, disk_idx, temp_idx
     )
-def update_visuals_for_Health(start_date, end_date):
-    filtered_health = df_health.copy()
-
-    # if device_id:
-    #     filtered = filtered[filtered["device_id_id"] == device_id]
-
-    filtered_health = filtered_health[filtered_health["device_id_id"] == 1]
-    
-
+def update_visuals_for_Health(start_date, end_date, device=ALL_DEVICES, session_id=None):
     start_dt = pd.to_datetime(start_date, utc=True)
     end_dt = pd.to_datetime(end_date, utc=True) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
 
-
-    filtered_health = filtered_health[(filtered_health["timestamp"] >= start_dt) & (filtered_health["timestamp"] <= end_dt)]
-    print("filtered_health:", filtered_health)
+    # Peaks from the (device, timestamp) index, means from its hourly rollups;
+    # ALL_DEVICES is the fleet partition of both
+    data = health_dataset.get()
+    health = data["index"]
 
     
     
     
     
 
-    max_cpu = filtered_health["cpu_usage"].max()
-    peak_cpu_df = filtered_health[filtered_health["cpu_usage"] == max_cpu]
-
-    if not peak_cpu_df.empty:
-        peak_cpu_df[["start_hour", "end_hour"]] = peak_cpu_df["hour"].apply(lambda h: pd.Series(get_hour_range(h)))
-        peak_cpu_df["summary"] = peak_cpu_df.apply(
-            lambda row: f"{row['cpu_usage']}%, {row['date']}, {row['weekday']}, {row['start_hour']}-{row['end_hour']}", axis=1)
-        last_peak_cpu_10_summaries = peak_cpu_df.sort_values(by="timestamp", ascending=True)["summary"].tolist()
-    else:
-        last_peak_cpu_10_summaries = None
-
-    # Memory
-    max_memory_usage = filtered_health["memory_usage"].max()
-    peak_memory_df = filtered_health[filtered_health["memory_usage"] == max_memory_usage]
-
-    if not peak_memory_df.empty:
-        peak_memory_df[["start_hour", "end_hour"]] = peak_memory_df["hour"].apply(lambda h: pd.Series(get_hour_range(h)))
-        peak_memory_df["summary"] = peak_memory_df.apply(
-            lambda row: f"{row['memory_usage']} MB, {row['date']}, {row['weekday']}, {row['start_hour']}-{row['end_hour']}", axis=1)
-        last_peak_memory_10_summaries = peak_memory_df.sort_values(by="timestamp", ascending=True)["summary"].tolist()
-    else:
-        last_peak_memory_10_summaries = None
-
-    # Disk
-    max_disk_usage = filtered_health["disk_usage"].max()
-    peak_disk_df = filtered_health[filtered_health["disk_usage"] == max_disk_usage]
-
-    if not peak_disk_df.empty:
-        peak_disk_df[["start_hour", "end_hour"]] = peak_disk_df["hour"].apply(lambda h: pd.Series(get_hour_range(h)))
-        peak_disk_df["summary"] = peak_disk_df.apply(
-            lambda row: f"{row['disk_usage']}%, {row['date']}, {row['weekday']}, {row['start_hour']}-{row['end_hour']}", axis=1)
-        last_peak_disk_10_summaries = peak_disk_df.sort_values(by="timestamp", ascending=True)["summary"].tolist()
-    else:
-        last_peak_disk_10_summaries = None
-
-    # Temperature
-    max_temperature = filtered_health["temperature"].max()
-    peak_temp_df = filtered_health[filtered_health["temperature"] == max_temperature]
-
-    if not peak_temp_df.empty:
-        peak_temp_df[["start_hour", "end_hour"]] = peak_temp_df["hour"].apply(lambda h: pd.Series(get_hour_range(h)))
-        peak_temp_df["summary"] = peak_temp_df.apply(
-            lambda row: f"{row['temperature']} C, {row['date']}, {row['weekday']}, {row['start_hour']}-{row['end_hour']}", axis=1)
-        last_peak_temperature_10_summaries = peak_temp_df.sort_values(by="timestamp", ascending=True)["summary"].tolist()
-    else:
-        last_peak_temperature_10_summaries = None
+    last_peak_cpu_10_summaries = peak_summaries(health.peak_rows(device, start_dt, end_dt, "cpu_usage"), "cpu_usage", "%")
+    last_peak_memory_10_summaries = peak_summaries(health.peak_rows(device, start_dt, end_dt, "memory_usage"), "memory_usage", " MB")
+    last_peak_disk_10_summaries = peak_summaries(health.peak_rows(device, start_dt, end_dt, "disk_usage"), "disk_usage", "%")
+    last_peak_temperature_10_summaries = peak_summaries(health.peak_rows(device, start_dt, end_dt, "temperature"), "temperature", " C")
 
     kpi_blocks = [
     # Stores for navigation indices and lists
-    dcc.Store(id="cpu-kpi-index", data=len(last_peak_cpu_10_summaries) - 1),
+    dcc.Store(id="cpu-kpi-index", data=len(last_peak_cpu_10_summaries or []) - 1),
     dcc.Store(id="cpu-kpi-list", data=last_peak_cpu_10_summaries),
-    dcc.Store(id="memory-kpi-index", data=len(last_peak_memory_10_summaries) - 1),
+    dcc.Store(id="memory-kpi-index", data=len(last_peak_memory_10_summaries or []) - 1),
     dcc.Store(id="memory-kpi-list", data=last_peak_memory_10_summaries),
-    dcc.Store(id="disk-kpi-index", data=len(last_peak_disk_10_summaries) - 1),
+    dcc.Store(id="disk-kpi-index", data=len(last_peak_disk_10_summaries or []) - 1),
     dcc.Store(id="disk-kpi-list", data=last_peak_disk_10_summaries),
-    dcc.Store(id="temperature-kpi-index", data=len(last_peak_temperature_10_summaries) - 1),
+    dcc.Store(id="temperature-kpi-index", data=len(last_peak_temperature_10_summaries or []) - 1),
     dcc.Store(id="temperature-kpi-list", data=last_peak_temperature_10_summaries),
 
     # CPU KPI block
@@ -692,31 +909,27 @@ def update_visuals_for_Health(start_date, end_date):
 ]
 
 
-    yearly_health = filtered_health.groupby("year", as_index=False).agg({
-    "cpu_usage": "mean",
-    "memory_usage": "mean",
-    "disk_usage": "mean",
-    "temperature": "mean"
-}).round(2)
-    # Monthly averages
-    monthly_health = filtered_health.groupby("month", as_index=False).agg({
-    "cpu_usage": "mean",
-    "memory_usage": "mean",
-    "disk_usage": "mean",
-    "temperature": "mean"
-}).round(2)
-    weekday_health = filtered_health.groupby("weekday", as_index=False).agg({
-    "cpu_usage": "mean",
-    "memory_usage": "mean",
-    "disk_usage": "mean",
-    "temperature": "mean"
-}).round(2)
-    hour_health = filtered_health.groupby("hour", as_index=False).agg({
-    "cpu_usage": "mean",
-    "memory_usage": "mean",
-    "disk_usage": "mean",
-    "temperature": "mean"
-}).round(2)
+    # The calendar means come from the device's hourly sums / counts
+    # (per session only the days that entered / left the range are read)
+    totals = None
+    if session_id:
+        ranges = session_ranges.get(session_id, ("Health", device), data["hourly"],
+                                    partial(hourly_rows, data["hourly"], HEALTH_SUM_COLUMNS, device), HEALTH_SUM_COLUMNS)
+        totals = ranges.update(*range_days(start_dt, end_dt))
+        if not totals.rows():
+            totals = None
+    if totals is not None:
+        yearly_health, monthly_health, weekday_health, hour_health = (
+            health_means_from_sums(totals.frame(key), key) for key in ["year", "month", "weekday", "hour"])
+    else:
+        hourly_health = data["hourly"].slice(device, start_dt, end_dt)
+        yearly_health = health_means(hourly_health, "year")
+        # Monthly averages
+        monthly_health = health_means(hourly_health, "month")
+        weekday_health = health_means(hourly_health, "weekday")
+        hour_health = health_means(hourly_health, "hour")
+    yearly_health, monthly_health, weekday_health, hour_health = map(
+        label_calendar, (yearly_health, monthly_health, weekday_health, hour_health))
     
     
     # # Chart creation
@@ -969,6 +1182,12 @@ def update_visuals_for_Health(start_date, end_date):
         )
     )
 
+    # Percentiles from the (device, hour) quantile sketches, no raw samples are sorted
+    hour_percentile_fig, weekday_percentile_fig, month_percentile_fig = (
+        percentile_figure(label_calendar(health_percentiles(data["quantiles"], sketch_devices(device), start_dt, end_dt, by)), by, title)
+        for by, title in [("hour", "Health Percentiles per Hour"), ("weekday", "Health Percentiles per Weekday"),
+                          ("month", "Health Percentiles per Month")])
+
     # # 3.Line Chart
     # line_data = []
     # for _, row in filtered.iterrows():
@@ -1073,6 +1292,18 @@ def update_visuals_for_Health(start_date, end_date):
                         style={"height": "400px", "width": "100%"}
                     )
                 ], width=12)
+            ]),
+
+            dbc.Row([
+                dbc.Col([
+                    dcc.Graph(
+                        id=f"{by}-health-percentiles",
+                        figure=fig,
+                        config={"responsive": True},
+                        style={"height": "400px", "width": "100%"}
+                    )
+                ], width=4)
+                for by, fig in [("hour", hour_percentile_fig), ("weekday", weekday_percentile_fig), ("month", month_percentile_fig)]
             ])
             ]
 
@@ -1082,6 +1313,18 @@ def update_visuals_for_Health(start_date, end_date):
     return kpi_blocks, charts
     
 
+# "<value><unit>, <date>, <weekday>, <hour-1>-<hour+1>" for each peak row
+# (oldest first, at most PEAK_HISTORY from DeviceTimeIndex.peak_rows), or None if there are none.
+def peak_summaries(peak, metric, unit):
+    if peak.empty:
+        return None
+    summaries = []
+    for value, date, weekday, hour in zip(peak[metric], peak["date"], peak["weekday"], peak["hour"]):
+        start_hour, end_hour = get_hour_range(hour)
+        summaries.append(f"{value}{unit}, {date}, {WEEKDAY_NAMES[weekday]}, {start_hour}-{end_hour}")
+    return summaries
+
+
 def get_hour_range(hour):
     try:
         hour = int(hour)
@@ -1095,7 +1338,56 @@ def get_hour_range(hour):
         return "NA", "NA"
 
 
+HEALTH_METRIC_STYLES = {
+    "cpu_usage": ("CPU Usage", "#1f77b4"),
+    "memory_usage": ("Memory Usage", "#ff7f0e"),
+    "disk_usage": ("Disk Usage", "#2ca02c"),
+    "temperature": ("Temperature", "#d62728"),
+}
+
+
+# p50 / p90 / p99 lines per `by` key (see health_percentiles) for one metric
+# at a time, picked with buttons above the chart (no server round trip)
+def percentile_figure(percentiles, by, title):
+    fig = go.Figure()
+    for metric, (name, color) in HEALTH_METRIC_STYLES.items():
+        for p, dash_style in (("p50", "solid"), ("p90", "dash"), ("p99", "dot")):
+            fig.add_trace(go.Scatter(
+                x=percentiles[by],
+                y=percentiles.get(f"{metric}_{p}"),
+                mode="lines+markers",
+                name=f"{name} {p}",
+                line=dict(color=color, dash=dash_style),
+                visible=metric == "cpu_usage",
+            ))
+    metrics = list(HEALTH_METRIC_STYLES)
+    fig.update_layout(
+        title=title,
+        dragmode="pan",
+        plot_bgcolor="white",
+        paper_bgcolor="white",
+        xaxis=dict(title=by.capitalize(), gridcolor="#e6e6e6", zerolinecolor="#cccccc"),
+        yaxis=dict(title="Value", gridcolor="#e6e6e6", zerolinecolor="#cccccc"),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        updatemenus=[dict(
+            type="buttons",
+            direction="right",
+            x=0, y=1.25, xanchor="left", yanchor="bottom",
+            buttons=[dict(label=name, method="update",
+                          args=[{"visible": [m == metric for m in metrics for _ in range(3)]}])
+                     for metric, (name, _) in HEALTH_METRIC_STYLES.items()],
+        )],
+    )
+    return fig
+
+
+
+
 
+# TRACE_CALLBACK_MEMORY=1 prints the memory each Tag / Health render allocates
+if os.environ.get("TRACE_CALLBACK_MEMORY"):
+    update_visuals_for_Tag = trace_allocations(update_visuals_for_Tag)
+    update_visuals_for_Health = trace_allocations(update_visuals_for_Health)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,335 @@
+import itertools, os, shutil, sys, tempfile, time
+import numpy as np
+import pandas as pd
+from functools import partial
+from tag_health_loader import (parse_json, decode_json_payloads, load_tag_csv, build_tag_frame,
+                               parse_payload_timestamps, load_tag_shards,
+                               sort_by_device_time, DeviceTimeIndex, add_calendar_columns, rollup_health_frame,
+                               health_means, health_means_from_sums, health_hourly_rollups, HEALTH_METRICS,
+                               HEALTH_SUM_COLUMNS)
+from tag_health_cache import cached_frame, cache_paths
+from tag_health_store import SqliteTagStore
+from tag_health_delta import DeltaRange, hourly_rows, DAY
+from tag_health_sketch import tag_distinct_sketches, health_quantile_sketches, health_percentiles
+
+# Usage: python tag_health_benchmark.py [benchmark ...]
+# Row count of the synthetic sample comes from BENCH_ROWS (default 200000),
+# e.g. BENCH_ROWS=5000000 python tag_health_benchmark.py timestamps
+
+csv_path_tag = os.path.join(os.path.dirname(__file__), "data", "tag_data_from_customerdevicedata_table.csv")
+
+
+def timed(fn, *args, repeat=3):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+# Repeat the shipped export until it has `rows` rows (with unique ids)
+def sample_tag_frame(rows):
+    df = pd.read_csv(csv_path_tag)
+    copies = -(-rows // len(df))
+    sample = pd.concat([df] * copies, ignore_index=True).head(rows)
+    sample["id"] = range(1, len(sample) + 1)
+    return sample
+
+
+# Synthetic derived health frame: one device, readings every few minutes from Feb 2025
+def sample_health_frame(rows, seconds=None):
+    rng = np.random.default_rng(0)
+    seconds = seconds or rows * 300  # one reading about every 5 minutes by default
+    df = pd.DataFrame({
+        "timestamp": pd.Timestamp("2025-02-01", tz="UTC") + pd.to_timedelta(np.sort(rng.integers(0, seconds, rows)), unit="s"),
+        "device_id_id": 1,
+        "cpu_usage": rng.integers(0, 101, rows).astype(float),
+        "memory_usage": rng.integers(500, 2049, rows).astype(float),
+        "disk_usage": rng.integers(0, 101, rows).astype(float),
+        "temperature": rng.integers(30, 91, rows).astype(float),
+    })
+    return add_calendar_columns(df, "timestamp")
+
+
+# Write the sample to a temporary CSV and return its path
+def sample_tag_csv(rows):
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    sample_tag_frame(rows).to_csv(path, index=False, na_rep="NULL")
+    return path
+
+
+def frame_mb(df):
+    return df.memory_usage(deep=True).sum() / 2**20
+
+
+def report(name, rows, old, new):
+    print(f"{name:<28} rows={rows:>9}  old={old:8.3f}s  new={new:8.3f}s  speedup={old / new:6.1f}x")
+
+
+def bench_json_decoding(rows):
+    raw = sample_tag_frame(rows)["json_1"]
+    old, _ = timed(lambda: raw.apply(parse_json))
+    new, decoded = timed(decode_json_payloads, raw)
+    report("json_1 decoding", rows, old, new)
+    print(f"{'':<28} fallback rows={decoded.attrs['fallback_rows']} "
+          f"distinct payloads={decoded.attrs['unique_payloads']} (dedup ratio {decoded.attrs['dedup_ratio']:.1f}x)")
+
+
+def bench_timestamps(rows):
+    decoded = decode_json_payloads(sample_tag_frame(rows)["json_1"])
+    payloads = decoded["json_1"]
+    old, _ = timed(lambda: payloads.apply(lambda x: pd.to_datetime(x.get("timestamp"), utc=True) if isinstance(x, dict) and x.get("timestamp") else pd.NaT), repeat=1)
+    new, _ = timed(parse_payload_timestamps, decoded["payload_timestamp"])
+    report("payload timestamps", rows, old, new)
+
+
+def bench_tag_loader(rows):
+    path = sample_tag_csv(rows)
+    try:
+        old, full = timed(lambda: pd.read_csv(path, parse_dates=["created_at", "updated_at"]), repeat=1)
+        new, projected = timed(load_tag_csv, path, repeat=1)
+    finally:
+        os.remove(path)
+    report("tag csv loading", rows, old, new)
+    print(f"{'':<28} frame {frame_mb(full):.1f} MB ({full.shape[1]} cols) -> "
+          f"{frame_mb(projected):.1f} MB ({projected.shape[1]} cols)")
+
+
+def bench_frame_cache(rows):
+    path = sample_tag_csv(rows)
+    try:
+        old, _ = timed(build_tag_frame, path, repeat=1)
+        cached_frame(path, build_tag_frame)  # writes the cache
+        new, _ = timed(cached_frame, path, build_tag_frame)
+    finally:
+        for p in (path, *cache_paths(path)):
+            if os.path.exists(p):
+                os.remove(p)
+    report("tag frame build vs cache", rows, old, new)
+
+
+# Current callback filtering (full copy + boolean masks) vs an indexed SQLite range query
+def bench_sqlite_source(rows):
+    path = sample_tag_csv(rows)
+    db_path = path + ".sqlite"
+    try:
+        df = build_tag_frame(path)
+        store = SqliteTagStore(db_path)
+        store.append(df)
+        for start, end in [("2025-04-21", "2025-04-21"), ("2025-03-13", "2025-03-20")]:
+            start_dt = pd.Timestamp(start, tz="UTC")
+            end_dt = pd.Timestamp(end, tz="UTC") + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+
+            def copy_and_mask():
+                filtered = df.copy()
+                filtered = filtered[filtered["device_id_id"] == 1]
+                return filtered[(filtered["json_timestamp"] >= start_dt) & (filtered["json_timestamp"] <= end_dt)]
+
+            old, expected = timed(copy_and_mask)
+            new, page = timed(store.query, start_dt, end_dt, 1)
+            report(f"filter {start}..{end}", rows, old, new)
+            print(f"{'':<28} {len(expected)} rows (mask) / {len(page)} rows (sqlite)")
+    finally:
+        for p in (path, db_path):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+# Sequential vs process-pool build of one shard per CPU
+def bench_shards(rows):
+    shard_dir = tempfile.mkdtemp()
+    try:
+        sample = sample_tag_frame(rows)
+        shards = max(2, os.cpu_count() or 1)
+        for i in range(shards):
+            sample.iloc[i::shards].to_csv(os.path.join(shard_dir, f"shard_{i:03d}.csv"), index=False, na_rep="NULL")
+        old, _ = timed(load_tag_shards, shard_dir, build_tag_frame, 1, repeat=1)
+        new, _ = timed(load_tag_shards, shard_dir, build_tag_frame, None, repeat=1)
+    finally:
+        shutil.rmtree(shard_dir)
+    report(f"{shards} shards, pool vs serial", rows, old, new)
+
+
+# The Tag callback's six per-group generator sums over json_1 vs groupby().sum() on tag_reads
+def bench_tag_reads(rows):
+    path = sample_tag_csv(rows)
+    try:
+        df = build_tag_frame(path)
+    finally:
+        os.remove(path)
+
+    def payload_reads(f):
+        return sum(
+            int(js.get("count", len(js.get("tags", [])))) if isinstance(js := j, dict) and js.get("count") not in [None, '', 'null']
+            else len(js.get("tags", []))
+            for j in f["json_1"]
+        )
+
+    def generator_sums():
+        return [df.groupby(keys).apply(payload_reads) for keys in ("date", "hour", "year", ["year", "month"], "weekday", "hour")]
+
+    def column_sums():
+        return [df.groupby(keys)["tag_reads"].sum() for keys in ("date", "hour", "year", ["year", "month"], "weekday")]
+
+    old, expected = timed(generator_sums, repeat=1)
+    new, result = timed(column_sums)
+    report("tag reads per group", rows, old, new)
+    print(f"{'':<28} totals match: {all((e == r).all() for e, r in zip(expected, result))}")
+
+
+# Full copy + boolean masks vs two searchsorted calls on the (device, time) sorted frame
+def bench_range_slice(rows):
+    path = sample_tag_csv(rows)
+    try:
+        df = sort_by_device_time(build_tag_frame(path), "json_timestamp")
+    finally:
+        os.remove(path)
+    index = DeviceTimeIndex(df, "json_timestamp")
+    start_dt = pd.Timestamp("2025-03-13", tz="UTC")
+    end_dt = pd.Timestamp("2025-03-20 23:59:59", tz="UTC")
+
+    def copy_and_mask():
+        filtered = df.copy()
+        filtered = filtered[filtered["device_id_id"] == 1]
+        return filtered[(filtered["json_timestamp"] >= start_dt) & (filtered["json_timestamp"] <= end_dt)]
+
+    old, expected = timed(copy_and_mask)
+    new, sliced = timed(index.slice, 1, start_dt, end_dt)
+    report("date range filter", rows, old, new)
+    print(f"{'':<28} {len(expected)} rows (mask) / {len(sliced)} rows (slice)")
+
+
+# Four groupby(...).agg calls over the rows vs one hourly pass + means per granularity
+def bench_health_aggregation(rows):
+    df = sample_health_frame(rows)
+    keys = ("year", "month", "weekday", "hour")
+
+    def four_groupbys():
+        return [df.groupby(key, as_index=False).agg({m: "mean" for m in HEALTH_METRICS}).round(2) for key in keys]
+
+    def hourly_pass():
+        hourly = rollup_health_frame(df)
+        return [health_means(hourly, key) for key in keys]
+
+    old, expected = timed(four_groupbys)
+    new, result = timed(hourly_pass)
+    report("health calendar means", rows, old, new)
+    same = all(np.allclose(e[HEALTH_METRICS], r[HEALTH_METRICS]) for e, r in zip(expected, result))
+    print(f"{'':<28} means match: {same}")
+
+
+# max() + equality filter per metric over the range vs RangeMax + DailyTopK lookups (10 most recent peaks)
+def bench_peaks(rows):
+    index = DeviceTimeIndex(sample_health_frame(rows), "timestamp", max_columns=HEALTH_METRICS)
+    start_dt = pd.Timestamp("2025-03-13", tz="UTC")
+    end_dt = pd.Timestamp("2025-06-20 23:59:59", tz="UTC")
+
+    def scan():
+        filtered = index.slice(1, start_dt, end_dt)
+        return [filtered[filtered[m] == filtered[m].max()].tail(10) for m in HEALTH_METRICS]
+
+    old, expected = timed(scan)
+    new, result = timed(lambda: [index.peak_rows(1, start_dt, end_dt, m) for m in HEALTH_METRICS])
+    report("peak rows (4 metrics)", rows, old, new)
+    print(f"{'':<28} same rows: {all(e.index.equals(r.index) for e, r in zip(expected, result))}")
+
+
+# Scrubbing a 180-day window one day at a time: health means from the
+# hourly rollups of the whole window per step vs a DeltaRange that only
+# adds / drops the day that moved
+def bench_delta_range(rows):
+    hourly = DeviceTimeIndex(health_hourly_rollups(sample_health_frame(rows)), "hour_bucket")
+    first = pd.Timestamp("2025-03-01", tz="UTC")
+    steps = [(first + i * DAY, first + (179 + i) * DAY) for i in range(30)]
+
+    def full():
+        for a, b in steps:
+            rows_in_range = hourly.slice(1, a, b + DAY - pd.Timedelta(seconds=1))
+            [health_means(rows_in_range, key) for key in ["year", "month", "weekday", "hour"]]
+
+    def delta():
+        ranges = DeltaRange(hourly, partial(hourly_rows, hourly, HEALTH_SUM_COLUMNS, 1), HEALTH_SUM_COLUMNS)
+        ranges.update(*steps[0])  # the first range is always a full build
+        start = time.perf_counter()
+        for a, b in steps[1:]:
+            totals = ranges.update(a, b)
+            [health_means_from_sums(totals.frame(key), key) for key in ["year", "month", "weekday", "hour"]]
+        return time.perf_counter() - start
+
+    old, _ = timed(full, repeat=1)
+    new = min(delta() for _ in range(3))
+    report("30 one-day scrubs (180 d)", rows, old * 29 / 30, new)
+
+
+# Distinct sessions and tags of one device over a year: filter + nunique /
+# set of the exploded tag lists on the raw rows vs merging (device, hour) sketches
+def bench_distinct(rows):
+    rng = np.random.default_rng(0)
+    tags = np.array([f"TAG{i:08d}" for i in range(max(rows // 2, 1))], dtype=object)
+    df = pd.DataFrame({
+        "device_id_id": rng.integers(1, 9, rows),
+        "json_timestamp": pd.Timestamp("2025-01-01", tz="UTC") + pd.to_timedelta(np.sort(rng.integers(0, 365 * 86400, rows)), unit="s"),
+        "int_1": rng.integers(0, max(rows // 5, 1), rows),
+        "tag_count": np.full(rows, 2, dtype=np.int32),
+    })
+    df["tag_list"] = list(tags[rng.integers(0, len(tags), (rows, 2))])
+    start_dt, end_dt = pd.Timestamp("2025-01-01", tz="UTC"), pd.Timestamp("2025-12-31 23:59:59", tz="UTC")
+
+    def scan():
+        f = df[(df["device_id_id"] == 1) & (df["json_timestamp"] >= start_dt) & (df["json_timestamp"] <= end_dt)]
+        return f["int_1"].nunique(), len(set(itertools.chain.from_iterable(f["tag_list"])))
+
+    build, distinct = timed(tag_distinct_sketches, df, repeat=1)
+    old, expected = timed(scan)
+    new, result = timed(lambda: [distinct[name].count([1], start_dt, end_dt) for name in ("sessions", "tags")])
+    report("distinct sessions + tags", rows, old, new)
+    print(f"{'':<28} exact={expected} sketch={tuple(result)} "
+          f"entries={len(distinct['sessions']) + len(distinct['tags'])} build={build:.2f}s")
+
+
+# p50 / p90 / p99 of every health metric per hour, weekday and month over a
+# year of readings: groupby quantiles over the raw rows vs merging (device, hour) sketches
+def bench_percentiles(rows):
+    health = sample_health_frame(rows, seconds=365 * 86400)  # all rows within one year
+    index = DeviceTimeIndex(health, "timestamp")
+    start_dt, end_dt = pd.Timestamp("2025-02-01", tz="UTC"), pd.Timestamp("2026-01-31 23:59:59", tz="UTC")
+    keys = ["hour", "weekday", "month"]
+
+    def raw():
+        filtered = add_calendar_columns(index.slice(1, start_dt, end_dt)[["timestamp", *HEALTH_METRICS]], "timestamp", date=False)
+        return [filtered.groupby(key)[HEALTH_METRICS].quantile([0.5, 0.9, 0.99], interpolation="lower").unstack()
+                for key in keys]
+
+    build, quantiles = timed(health_quantile_sketches, index.df, HEALTH_METRICS, repeat=1)
+    old, expected = timed(raw)
+    new, result = timed(lambda: [health_percentiles(quantiles, [1], start_dt, end_dt, key) for key in keys])
+    report("health percentiles", rows, old, new)
+    error = max(
+        np.nanmax(np.abs(r[f"{m}_p{p}"].to_numpy() - e[(m, q)].to_numpy()) / np.abs(e[(m, q)].to_numpy()))
+        for e, r in zip(expected, result) for m in HEALTH_METRICS for p, q in (("50", 0.5), ("90", 0.9), ("99", 0.99)))
+    print(f"{'':<28} max relative error {error:.4f}, {sum(map(len, quantiles.values()))} sketch bins, build={build:.2f}s")
+
+
+BENCHMARKS = {
+    "json": bench_json_decoding,
+    "timestamps": bench_timestamps,
+    "loader": bench_tag_loader,
+    "cache": bench_frame_cache,
+    "sqlite": bench_sqlite_source,
+    "shards": bench_shards,
+    "tag_reads": bench_tag_reads,
+    "range_slice": bench_range_slice,
+    "health": bench_health_aggregation,
+    "peaks": bench_peaks,
+    "delta": bench_delta_range,
+    "distinct": bench_distinct,
+    "percentiles": bench_percentiles,
+}
+
+
+if __name__ == "__main__":
+    rows = int(os.environ.get("BENCH_ROWS", 200000))
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name](rows)
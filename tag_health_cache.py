@@ -0,0 +1,101 @@
+import hashlib, json, os
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (parquet engine)
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+
+# Bump whenever the derived columns built from the CSVs change,
+# so caches written by an older build are ignored.
+CACHE_VERSION = 6
+
+
+# Size, mtime and content hash of a source file
+def source_signature(path):
+    st = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": digest.hexdigest()}
+
+
+# The cache sits next to the source: <csv>.cache.parquet + <csv>.cache.json
+def cache_paths(source_path):
+    return source_path + ".cache.parquet", source_path + ".cache.json"
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Parquet has no type for free-form dicts (json_1), those columns are stored
+# as JSON text and decoded again with a single json.loads on load.
+def _to_columnar(df):
+    out, json_columns = df.copy(deep=False), []
+    for col in df.columns:
+        if df[col].dtype == object:
+            first = df[col].dropna().head(1)
+            if len(first) and isinstance(first.iloc[0], dict):
+                out[col] = [json.dumps(v) for v in df[col]]
+                json_columns.append(col)
+    return out, json_columns
+
+
+def _from_columnar(df, json_columns):
+    for col in json_columns:
+        df[col] = pd.Series(json.loads("[" + ",".join(df[col]) + "]"), index=df.index, dtype=object)
+    return df
+
+
+def _write_json(path, obj):
+    with open(path, "w") as f:
+        json.dump(obj, f)
+
+
+def _write_atomic(path, write):
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+# Return build(source_path), reusing the columnar cache while the source
+# size, mtime and hash (and CACHE_VERSION) are unchanged.
+# The returned frame records the source size it covers in attrs["source_size"]
+# (the file size, unless build records a smaller one, see complete_size).
+def cached_frame(source_path, build):
+    if not HAVE_PYARROW:
+        print("pyarrow is not installed, frame cache disabled")
+        size = os.path.getsize(source_path)
+        df = build(source_path)
+        df.attrs.setdefault("source_size", size)
+        return df
+
+    data_path, meta_path = cache_paths(source_path)
+    key = {"version": CACHE_VERSION, "build": build.__name__, **source_signature(source_path)}
+    meta = _read_meta(meta_path)
+    if meta and meta.get("key") == key and os.path.exists(data_path):
+        try:
+            df = _from_columnar(pd.read_parquet(data_path), meta.get("json_columns", []))
+            df.attrs["source_size"] = meta.get("source_size", key["size"])
+            return df
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable frame cache {data_path}: {e}")
+
+    df = build(source_path)
+    df.attrs.setdefault("source_size", key["size"])
+    try:
+        columnar, json_columns = _to_columnar(df)
+        _write_atomic(data_path, lambda p: columnar.to_parquet(p, index=False))
+        _write_atomic(meta_path, lambda p: _write_json(p, {"key": key, "json_columns": json_columns,
+                                                            "source_size": df.attrs["source_size"]}))
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Could not write frame cache {data_path}: {e}")
+    return df
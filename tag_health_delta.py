@@ -0,0 +1,168 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+DAY = pd.Timedelta(days=1)
+HOUR_NS = 3600 * 10**9
+CALENDAR_KEYS = ["weekday", "month", "year", "year_month"]
+
+
+# The UTC days [first_day, last_day] a picked date range covers
+def range_days(start_dt, end_dt):
+    return pd.Timestamp(start_dt).floor("D"), pd.Timestamp(end_dt).floor("D")
+
+
+# Aggregates of a date range kept between requests, updated by day-slices.
+# hourly(first_day, last_day) returns the hour buckets (a DatetimeIndex, at
+# most one per hour) that have rows in those days and a 2-D array of their summable
+# `columns`. Every day of the range is kept as a dense 24 x columns array
+# (plus a row count column), and the totals of the range, per hour of day
+# and per weekday, month, year and year+month are running sums over those
+# arrays. When the range moves only the days that left it are subtracted and
+# the days that entered it read and added, so scrubbing the picker costs
+# time in proportion to the change. A disjoint or mostly new range, and
+# every `full_every`-th update (to drop float drift from add/subtract), rebuilds.
+# update() returns a RangeTotals snapshot taken under the lock, so requests
+# of the same session that overlap never read each other's half-applied state.
+class DeltaRange:
+    def __init__(self, source, hourly, columns, full_every=32):
+        self.source = source  # the data version the day arrays were computed from
+        self.hourly = hourly
+        self.columns = list(columns) + ["rows"]
+        self.full_every = full_every
+        self.lock = threading.Lock()
+        self.first = self.last = None
+        self.unit = "ns"  # of the source's hour buckets
+        self.deltas = 0
+        self._reset()
+
+    def _reset(self):
+        self.days = {}
+        self.total = np.zeros(len(self.columns))
+        self.by_hour = np.zeros((24, len(self.columns)))
+        self.by_key = {name: {} for name in CALENDAR_KEYS}
+
+    # {day: 24 x columns array} for every day in [first_day, last_day]
+    def _read_days(self, first_day, last_day):
+        count = (last_day - first_day) // DAY + 1
+        cube = np.zeros((count, 24, len(self.columns)))
+        buckets, values = self.hourly(first_day, last_day)
+        self.unit = buckets.unit
+        hours = (buckets.as_unit("ns").asi8 - first_day.value) // HOUR_NS
+        cube[hours // 24, hours % 24, :-1] = values
+        cube[hours // 24, hours % 24, -1] = 1
+        return {first_day + i * DAY: cube[i] for i in range(count)}
+
+    def _apply(self, days, sign):
+        for day, hours in days.items():
+            total = hours.sum(axis=0)
+            if not total[-1]:
+                continue  # no rows that day
+            self.total += sign * total
+            self.by_hour += sign * hours
+            for name, key in zip(CALENDAR_KEYS, (day.dayofweek, day.month, day.year, (day.year, day.month))):
+                running = self.by_key[name].get(key, 0) + sign * total
+                if running[-1]:
+                    self.by_key[name][key] = running
+                else:
+                    self.by_key[name].pop(key, None)
+
+    def update(self, first_day, last_day):
+        with self.lock:
+            changed = None
+            if self.first is not None and first_day <= self.last and last_day >= self.first and self.deltas < self.full_every:
+                removed = [*pd.date_range(self.first, min(first_day - DAY, self.last)),
+                           *pd.date_range(max(last_day + DAY, self.first), self.last)]
+                added = [(a, b) for a, b in [(first_day, self.first - DAY), (self.last + DAY, last_day)] if a <= b]
+                changed = len(removed) + sum((b - a) // DAY + 1 for a, b in added)
+            if changed is None or changed >= (last_day - first_day) // DAY + 1:
+                self._reset()
+                self.days = self._read_days(first_day, last_day)
+                self._apply(self.days, 1)
+                self.deltas = 0
+            elif changed:
+                self._apply({day: self.days.pop(day) for day in removed}, -1)
+                for a, b in added:
+                    new_days = self._read_days(a, b)
+                    self._apply(new_days, 1)
+                    self.days.update(new_days)
+                self.deltas += 1
+            self.first, self.last = first_day, last_day
+            return RangeTotals(self)
+
+
+# The totals of a DeltaRange at one update. The day arrays and the per-key
+# running sums are replaced, never written to, by later updates, so copying
+# the containers (and the two in-place accumulators) is enough.
+class RangeTotals:
+    def __init__(self, ranges):
+        self.columns = ranges.columns
+        self.unit = ranges.unit
+        self.days = dict(ranges.days)
+        self.total = ranges.total.copy()
+        self.by_hour = ranges.by_hour.copy()
+        self.by_key = {name: dict(keys) for name, keys in ranges.by_key.items()}
+
+    # Number of hour buckets with rows in the range
+    def rows(self):
+        return int(self.total[-1])
+
+    # Range totals per `name` ("hour" or one of CALENDAR_KEYS) indexed by the
+    # key, one row per key that has rows in the range
+    def frame(self, name):
+        if name == "hour":
+            keys = np.flatnonzero(self.by_hour[:, -1])
+            index, values = pd.Index(keys, name="hour"), self.by_hour[keys]
+        else:
+            keys = sorted(self.by_key[name])
+            values = np.array([self.by_key[name][key] for key in keys]).reshape(len(keys), len(self.columns))
+            if name == "year_month":
+                index = pd.MultiIndex.from_tuples(keys, names=["year", "month"])
+            else:
+                index = pd.Index(keys, name=name, dtype="int64")
+        return pd.DataFrame(values, index=index, columns=self.columns)
+
+    # Totals per day that has rows, by day
+    def daily(self):
+        days = [day for day in sorted(self.days) if self.days[day][:, -1].any()]
+        values = np.array([self.days[day].sum(axis=0) for day in days]).reshape(len(days), len(self.columns))
+        return pd.DataFrame(values, index=pd.DatetimeIndex(days), columns=self.columns)
+
+    # The hour buckets that have rows, in time order
+    def hourly_points(self):
+        days = sorted(self.days)
+        cube = np.array([self.days[day] for day in days]).reshape(len(days) * 24, len(self.columns))
+        keep = np.flatnonzero(cube[:, -1])
+        index = pd.to_datetime(days[0].value + keep * HOUR_NS if days else keep, unit="ns", utc=True).as_unit(self.unit)
+        return pd.DataFrame(cube[keep], index=index, columns=self.columns)
+
+
+TAG_SUMMED = ["reads", "sessions", "successes", "failures"]
+
+
+# Hour buckets of one device's hourly rollups (a DeviceTimeIndex over the tag
+# or health rollups, at most one row per device and hour) in [first_day, last_day]
+def hourly_rows(rollups, columns, device, first_day, last_day):
+    rows = rollups.slice(device, first_day, last_day + DAY - pd.Timedelta(seconds=1))
+    return pd.DatetimeIndex(rows["hour_bucket"]), rows[columns].to_numpy(dtype=float)
+
+
+# Per-session DeltaRange objects, least recently used dropped past max_sessions
+class SessionRanges:
+    def __init__(self, max_sessions=256):
+        self.max_sessions = max_sessions
+        self.ranges = OrderedDict()
+        self.lock = threading.Lock()
+
+    # The session's DeltaRange for `key` over `source`, new if the data changed
+    def get(self, session_id, key, source, hourly, columns):
+        with self.lock:
+            entry = self.ranges.get((session_id, key))
+            if entry is None or entry.source is not source:
+                entry = DeltaRange(source, hourly, columns)
+                self.ranges[(session_id, key)] = entry
+            self.ranges.move_to_end((session_id, key))
+            while len(self.ranges) > self.max_sessions:
+                self.ranges.popitem(last=False)
+            return entry
@@ -0,0 +1,707 @@
+import ast, functools, glob, heapq, io, json, os
+import multiprocessing, tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from tag_health_sketch import tag_distinct_sketches, merge_tag_distinct_sketches, empty_tag_distinct_sketches
+
+
+# Columns of the customerdevicedata export the dashboards actually use
+TAG_COLUMNS = ["id", "created_at", "updated_at", "int_1", "char_1", "json_1", "device_id_id"]
+
+
+# Resident set size of this process in MB (nan where it can't be read)
+def resident_memory_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return float("nan")
+
+
+# Wrap fn so each call prints the peak memory it allocated (tracemalloc).
+# Tracing slows every allocation down and concurrent calls share one
+# tracer, so this is for measuring, not for normal serving.
+def trace_allocations(fn):
+    @functools.wraps(fn)
+    def traced(*args, **kwargs):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            print(f"{fn.__name__}: peak {(peak - before) / 2**20:.2f} MB allocated, {(current - before) / 2**20:.2f} MB retained")
+    return traced
+
+
+# An export that is still being written ends in a partial line. Full loads
+# read only the complete lines, up to and including the last newline, and
+# record that byte position as the source size TagTail continues from, so
+# the partial row is read once it is complete.
+def complete_size(path, block=1 << 16):
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - block)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+# The first `size` bytes of a file as a binary stream
+class _FilePrefix(io.RawIOBase):
+    def __init__(self, path, size):
+        self.file, self.left = open(path, "rb"), size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.file.readinto(memoryview(buffer)[:min(len(buffer), self.left)])
+        self.left -= n
+        return n
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def open_complete_lines(path, size):
+    return io.BufferedReader(_FilePrefix(path, size))
+
+
+# Load the tag export projected to TAG_COLUMNS with compact dtypes:
+# NULL is missing, char_1 is categorical and device ids are small integers.
+def _read_tag_csv(path, columns=TAG_COLUMNS, **kwargs):
+    return pd.read_csv(
+        path,
+        usecols=lambda c: c in columns,
+        na_values=["NULL"],
+        dtype={"char_1": "category"},
+        parse_dates=[c for c in ("created_at", "updated_at") if c in columns],
+        **kwargs,
+    )
+
+
+def _compact_device_ids(df):
+    if "device_id_id" in df:
+        df["device_id_id"] = pd.to_numeric(df["device_id_id"], downcast="integer")
+    return df
+
+
+# Only the first `size` bytes of the file when size is given (see complete_size)
+def load_tag_csv(path, columns=TAG_COLUMNS, size=None):
+    rss_before = resident_memory_mb()
+    if size is None:
+        df = _compact_device_ids(_read_tag_csv(path, columns))
+    else:
+        with open_complete_lines(path, size) as f:
+            df = _compact_device_ids(_read_tag_csv(f, columns))
+    rss_after = resident_memory_mb()
+    frame_mb = df.memory_usage(deep=True).sum() / 2**20
+    print(f"tag data: {len(df)} rows x {df.shape[1]} cols, frame {frame_mb:.1f} MB, "
+          f"rss {rss_before:.1f} -> {rss_after:.1f} MB")
+    return df
+
+
+# Parse JSON the old way, one ast.literal_eval per row (kept as the benchmark baseline)
+def parse_json(val):
+    try:
+        return ast.literal_eval(val) if isinstance(val, str) else val
+    except Exception:
+        return {}
+
+
+def _loads_or_none(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+# Slow path for payloads that are not valid JSON (python-literal dicts);
+# like parse_json but None instead of {} when the text can't be parsed
+def _literal_or_none(text):
+    try:
+        return ast.literal_eval(text)
+    except Exception:
+        return None
+
+
+# Decode the whole json_1 column in one pass with the json parser.
+# Readers often re-send byte-identical payloads, so the raw strings are
+# factorized first and each distinct string is parsed once; the results are
+# broadcast back to the rows through the factorization codes (rows with the
+# same string share one payload dict and tag list, treat them as read-only).
+# The distinct strings are joined into a single JSON array and parsed with one
+# json.loads call; if that fails (some row is not valid JSON) each string is parsed
+# on its own and only the ones json rejects go through the slow literal_eval path.
+# Returns json_1 (dicts) plus typed tag_list / tag_count / tag_reads / payload_timestamp and
+# payload_error ("missing_payload" / "invalid_json" for rows the slow path also rejects).
+def decode_json_payloads(raw):
+    values = raw.to_numpy(dtype=object)
+    is_text = np.fromiter((isinstance(v, str) for v in values), dtype=bool, count=len(values))
+    codes, texts = pd.factorize(values[is_text])
+
+    parsed = None
+    if len(texts):
+        try:
+            parsed = json.loads("[" + ",".join(texts) + "]")
+        except ValueError:
+            parsed = None
+        if parsed is None or len(parsed) != len(texts):
+            parsed = [_loads_or_none(text) for text in texts]
+
+    # One entry per distinct string, followed by one per non-text row
+    others = values[~is_text]
+    payloads = [v if isinstance(v, dict) else {} for v in others]
+    errors = [None if isinstance(v, dict) else "missing_payload" for v in others]
+    text_errors = [None] * len(texts)
+    fallback = np.zeros(len(texts), dtype=bool)
+    for i, (text, js) in enumerate(zip(texts, parsed or [])):
+        if not isinstance(js, dict):
+            fallback[i] = True
+            js = _literal_or_none(text)
+            if not isinstance(js, dict):
+                js, text_errors[i] = {}, "invalid_json"
+            parsed[i] = js
+    payloads = (parsed or []) + payloads
+    errors = text_errors + errors
+
+    entry = np.empty(len(values), dtype=np.intp)
+    entry[is_text] = codes
+    entry[~is_text] = len(texts) + np.arange(len(others))
+
+    tag_list = [js.get("tags") if isinstance(js.get("tags"), list) else [] for js in payloads]
+    tag_count = np.fromiter(map(len, tag_list), dtype=np.int32, count=len(tag_list))
+    tag_reads = payload_tag_reads(payloads, pd.Series(tag_count)).to_numpy()
+    timestamps = [js.get("timestamp") or None for js in payloads]
+
+    decoded = pd.DataFrame({
+        "json_1": _take(payloads, entry),
+        "tag_list": _take(tag_list, entry),
+        "tag_count": tag_count[entry],
+        "tag_reads": tag_reads[entry],
+        "payload_timestamp": pd.Series(_take(timestamps, entry), dtype=object),
+        "payload_error": _take(errors, entry),
+    })
+    decoded.index = raw.index
+    decoded.attrs["fallback_rows"] = int(np.count_nonzero(fallback[codes]))
+    decoded.attrs["unique_payloads"] = len(texts)
+    decoded.attrs["dedup_ratio"] = len(codes) / len(texts) if len(texts) else 1.0
+    return decoded
+
+
+# items[positions] for a list of python objects (lists stay single elements)
+def _take(items, positions):
+    out = np.empty(len(items), dtype=object)
+    out[:] = items
+    return out[positions]
+
+
+# Payload timestamps as written by the readers, e.g. 2025-02-10T12:34:56Z
+PAYLOAD_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+# Convert the payload timestamp strings in one vectorized call with the fixed
+# reader format; only strings in another ISO-8601 shape get a second, ISO8601 pass.
+def parse_payload_timestamps(values):
+    ts = pd.to_datetime(values, format=PAYLOAD_TIMESTAMP_FORMAT, utc=True, errors="coerce")
+    retry = ts.isna() & values.notna()
+    if retry.any():
+        ts[retry] = pd.to_datetime(values[retry], format="ISO8601", utc=True, errors="coerce")
+    return ts
+
+
+# Tag reads per payload: the reader's "count" when it is numeric, else the number of tags
+def payload_tag_reads(payloads, tag_count):
+    counts = pd.to_numeric(pd.Series([js.get("count") for js in payloads], index=tag_count.index, dtype=object), errors="coerce")
+    return counts.fillna(tag_count).astype("int64")
+
+
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+WEEKDAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+# Calendar fields used by the year / month / weekday / hour charts, stored as
+# small integer codes (month 1-12, weekday 0=Monday, hour 0-23). Labels are
+# only attached to the aggregated frames, see label_calendar.
+def add_calendar_columns(df, ts_col, date=True):
+    ts = df[ts_col].dt
+    df["year"] = ts.year.astype("Int16")
+    df["month"] = ts.month.astype("Int8")
+    df["weekday"] = ts.dayofweek.astype("Int8")
+    df["hour"] = ts.hour.astype("Int8")
+    if date:  # python date objects, the slowest of the five
+        df["date"] = ts.date
+    return df
+
+
+# Integer calendar codes -> chart labels (Jan, Monday, 09, ...)
+def label_calendar(df):
+    df = df.copy()
+    if "year" in df:
+        df["year"] = df["year"].astype(str)
+    if "month" in df:
+        df["month"] = df["month"].map(lambda m: MONTH_NAMES[m - 1])
+    if "weekday" in df:
+        df["weekday"] = df["weekday"].map(lambda d: WEEKDAY_NAMES[d])
+    if "hour" in df:
+        df["hour"] = df["hour"].map("{:02d}".format)
+    return df
+
+
+# Reason codes of quarantined tag rows, in check order: no json_1 payload,
+# undecodable json_1, "tags" not a list, "count" given but not numeric, no
+# parseable payload timestamp
+PAYLOAD_ERRORS = ["missing_payload", "invalid_json", "tags_not_list", "count_not_numeric", "bad_timestamp"]
+
+
+# Validate every payload once at ingest: tags must be a list, count (when
+# given) numeric and the timestamp parseable. Returns payload_error as a
+# categorical reason code per row (NaN = clean), the first failing check wins.
+def validate_tag_payloads(df):
+    tags_ok = np.fromiter((isinstance(js.get("tags"), list) for js in df["json_1"]), dtype=bool, count=len(df))
+    counts = pd.Series([js.get("count") for js in df["json_1"]], index=df.index, dtype=object)
+    count_given = counts.notna() & ~counts.isin(["", "null"])
+    count_ok = ~count_given | pd.to_numeric(counts, errors="coerce").notna()
+    reason = np.select(
+        [df["payload_error"].notna(), ~tags_ok, ~count_ok.to_numpy(), df["json_timestamp"].isna().to_numpy()],
+        [df["payload_error"].to_numpy(), "tags_not_list", "count_not_numeric", "bad_timestamp"],
+        default=None,
+    )
+    return pd.Categorical(reason, categories=PAYLOAD_ERRORS)
+
+
+# Rows that failed validation, kept aside with their reason code
+def split_quarantine(df):
+    rejected = df["payload_error"].notna()
+    if rejected.any():
+        print(f"tag data: {int(rejected.sum())} rows quarantined "
+              f"({df.loc[rejected, 'payload_error'].value_counts()[lambda n: n > 0].to_dict()})")
+    return df[~rejected].reset_index(drop=True), df[rejected].reset_index(drop=True)
+
+
+# Fully derived tag frame: projected CSV, decoded and validated payloads and calendar columns
+def build_tag_frame(path):
+    size = complete_size(path) if isinstance(path, (str, os.PathLike)) else None  # TagTail passes a buffer
+    df = load_tag_csv(path, size=size)  # only the columns the dashboards use
+    # Parse JSON: one batch json decode, literal_eval only for rows that are not valid JSON
+    decoded = decode_json_payloads(df["json_1"])
+    print(f"tag data: {len(df)} payloads, {decoded.attrs['unique_payloads']} distinct "
+          f"(dedup ratio {decoded.attrs['dedup_ratio']:.1f}x)")
+    df[decoded.columns] = decoded
+    df["json_timestamp"] = parse_payload_timestamps(df["payload_timestamp"])
+    df["payload_error"] = validate_tag_payloads(df)
+    df = add_calendar_columns(df, "json_timestamp")
+    if size is not None:
+        df.attrs["source_size"] = size
+    return df
+
+
+# Fully derived health frame, sorted by (device, timestamp) for DeviceTimeIndex
+def build_health_frame(path):
+    df_health = pd.read_csv(path, parse_dates=["created_at", "updated_at"])
+    df_health["timestamp"] = pd.to_datetime(
+        df_health["timestamp"], errors="coerce", utc=True
+    )
+    df_health = sort_by_device_time(df_health, "timestamp")
+    return add_calendar_columns(df_health, "timestamp")
+
+
+# Order rows by device, then time (rows without a timestamp last per device)
+def sort_by_device_time(df, ts_col):
+    return df.sort_values(["device_id_id", ts_col], kind="stable", na_position="last", ignore_index=True)
+
+
+ALL_DEVICES = -1  # device key of the fleet-wide partition, see with_fleet_partition
+
+
+# Date-range lookups on a frame sorted by (device_id_id, ts_col): a per-device
+# offset table plus the timestamps as int64 ns, so slice() is two searchsorted
+# calls inside the device's rows and returns a positional slice of the frame
+# instead of a boolean mask over every row. Rows with a NaT timestamp sit at
+# the end of their device and are outside every range.
+class DeviceTimeIndex:
+    def __init__(self, df, ts_col, max_columns=(), peak_k=10):
+        self.df = df
+        self.ts_col = ts_col
+        self.range_max = {col: RangeMax(df[col].to_numpy(dtype=float)) for col in max_columns}
+        ts = pd.DatetimeIndex(df[ts_col]).as_unit("ns")
+        self.ts = ts.asi8
+        devices = df["device_id_id"].to_numpy()
+        self.daily_top = {col: DailyTopK(df[col].to_numpy(dtype=float), self.ts, devices, peak_k) for col in max_columns}
+        self.offsets = {}
+        if len(df):
+            starts = np.flatnonzero(np.r_[True, devices[1:] != devices[:-1]])
+            valid_ends = starts + np.add.reduceat(~ts.isna(), starts)
+            self.offsets = dict(zip(devices[starts].tolist(), zip(starts.tolist(), valid_ends.tolist())))
+
+    # Rows of `device` with start <= timestamp <= end, as a positional slice
+    # that shares the frame's data (treat it as read-only)
+    def slice(self, device, start, end):
+        first, last = self.bounds(device, start, end)
+        return self.df.iloc[first:last]
+
+    # Row positions [first, last) of that slice
+    def bounds(self, device, start, end):
+        lo, hi = self.offsets.get(device, (0, 0))
+        ts = self.ts[lo:hi]
+        first = lo + np.searchsorted(ts, pd.Timestamp(start).value, side="left")
+        last = lo + np.searchsorted(ts, pd.Timestamp(end).value, side="right")
+        return int(first), int(last)
+
+    # The (at most k) most recent rows of the slice where `col` (one of
+    # max_columns) is at its maximum, in time order. ALL_DEVICES combines
+    # the lookups of every device.
+    def peak_rows(self, device, start, end, col):
+        if device != ALL_DEVICES:
+            first, last = self.bounds(device, start, end)
+            peak = self.range_max[col].max(first, last)
+            return self.df.iloc[self.daily_top[col].recent_at(first, last, peak)]
+        bounds = [self.bounds(d, start, end) for d in self.offsets]
+        peak = max((self.range_max[col].max(first, last) for first, last in bounds), default=-np.inf)
+        rows = np.concatenate([self.daily_top[col].recent_at(first, last, peak) for first, last in bounds] or
+                              [np.empty(0, dtype=np.intp)])
+        rows = rows[np.argsort(self.ts[rows], kind="stable")][-self.daily_top[col].k:]
+        return self.df.iloc[rows]
+
+    # Device ids in the frame, without the fleet partition
+    def devices(self):
+        return sorted(d for d in self.offsets if d != ALL_DEVICES)
+
+    # Oldest and newest timestamp over all devices
+    def time_range(self):
+        ts = self.df[self.ts_col]
+        return ts.min(), ts.max()
+
+
+# Add the fleet-wide partition to a frame of per-(device, ts_col bucket)
+# aggregates: rows with device_id_id == ALL_DEVICES holding each bucket's
+# totals over every device (sum_columns summed, min_columns / max_columns
+# as min / max, other columns taken from the first device). "All devices"
+# is then one more device of the same index, a lookup like any other.
+# An existing fleet partition is replaced.
+def with_fleet_partition(df, ts_col, sum_columns, min_columns=(), max_columns=()):
+    df = df[df["device_id_id"] != ALL_DEVICES]
+    how = {col: "first" for col in df.columns if col not in ("device_id_id", ts_col)}
+    for columns, func in ((sum_columns, "sum"), (min_columns, "min"), (max_columns, "max")):
+        how.update(dict.fromkeys(columns, func))
+    fleet = df.groupby(ts_col, as_index=False, sort=True).agg(how)
+    fleet.insert(0, "device_id_id", ALL_DEVICES)
+    return sort_by_device_time(pd.concat([df, fleet[df.columns]], ignore_index=True), ts_col)
+
+
+# Concatenate derived frames, keeping categorical columns categorical
+def concat_frames(frames):
+    combined = pd.concat(frames, ignore_index=True)
+    for col in frames[0].columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype) and not isinstance(combined[col].dtype, pd.CategoricalDtype):
+            combined[col] = combined[col].astype("category")
+    return combined
+
+
+# Append newly parsed rows to a derived frame
+def append_rows(df, new_rows):
+    return concat_frames([df, new_rows])
+
+
+# A tag source is either one CSV, a directory of CSV shards or a glob pattern
+def is_sharded_source(source):
+    return os.path.isdir(source) or glob.has_magic(source)
+
+
+def tag_shard_paths(source):
+    pattern = os.path.join(source, "*.csv") if os.path.isdir(source) else source
+    return sorted(glob.glob(pattern))
+
+
+# Build every shard (one CSV per day per site) in its own worker process and
+# concatenate the results into one tag frame. `load` runs in the workers and
+# must be picklable, e.g. build_tag_frame or partial(cached_frame, build=build_tag_frame).
+def load_tag_shards(source, load=build_tag_frame, workers=None):
+    paths = tag_shard_paths(source)
+    if not paths:
+        raise FileNotFoundError(f"No tag CSV shards found for {source}")
+    if len(paths) == 1 or workers == 1:
+        frames = [load(path) for path in paths]
+    else:
+        # never fork: this runs in a callback thread of the (multi-threaded)
+        # server, and importing the dashboard module in a fresh worker loads no data
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            frames = list(pool.map(load, paths))
+    df = concat_frames(frames)
+    print(f"tag data: {len(paths)} shards, {len(df)} rows")
+    return df
+
+
+# Tail reader for an export that only ever grows by appended rows.
+# Remembers the byte offset and the last row id it has handed out, reads only
+# the bytes after the offset (up to the last complete line) and builds them
+# with the same derivation as the full load.
+# offset / last_id can be given directly when there is no frame (session store).
+class TagTail:
+    def __init__(self, path, df=None, build=build_tag_frame, offset=None, last_id=None):
+        self.path = path
+        self.build = build
+        if df is not None:
+            offset = df.attrs.get("source_size", os.path.getsize(path))
+            if "id" in df:
+                last_id = df["id"].max() if len(df) else -1
+            else:
+                last_id = df.attrs.get("last_id", -1)  # rollups
+        self.last_id = -1 if last_id is None else last_id
+        with open(path, "rb") as f:
+            self.header = f.readline()
+        self.offset = max(offset or 0, len(self.header))  # always the start of a line
+
+    # The export was rotated / rewritten and needs a full reload
+    def shrunk(self):
+        return os.path.getsize(self.path) < self.offset
+
+    # New complete rows since the last call, or None if there are none
+    def read_new_rows(self):
+        size = os.path.getsize(self.path)
+        if size <= self.offset:
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            chunk = f.read(size - self.offset)
+        end = chunk.rfind(b"\n") + 1  # a last line still being written waits for the next call
+        if not end:
+            return None
+        self.offset += end
+        new_rows = self.build(io.BytesIO(self.header + chunk[:end]))
+        new_rows = new_rows[new_rows["id"] > self.last_id]
+        if new_rows.empty:
+            return None
+        self.last_id = new_rows["id"].max()
+        return new_rows
+
+
+ROLLUP_COLUMNS = ["reads", "sessions", "successes", "failures"]
+
+
+# Per-device, per-hour rollup (reads, sessions, successes, failures) of a derived
+# tag frame; `reads` can be passed in when the frame has no payloads (session store).
+def rollup_tag_frame(df, reads=None):
+    rows = pd.DataFrame({
+        "device_id_id": df["device_id_id"],
+        "hour_bucket": df["json_timestamp"].dt.floor("1h"),
+        "reads": df["tag_reads"] if reads is None else reads,
+        "session": df["int_1"],
+        "successes": (df["char_1"] == "success").astype("int64"),
+        "failures": (df["char_1"] == "failed").astype("int64"),
+    })
+    return rows.groupby(["device_id_id", "hour_bucket"], observed=True).agg(
+        reads=("reads", "sum"),
+        sessions=("session", "nunique"),
+        successes=("successes", "sum"),
+        failures=("failures", "sum"),
+    ).reset_index()
+
+
+HEALTH_METRICS = ["cpu_usage", "memory_usage", "disk_usage", "temperature"]
+DAY_NS = 86400 * 10**9
+
+
+# One pass over health rows: sum / count / min / max of every metric per
+# (device, hour bucket) (columns cpu_usage_sum, cpu_usage_count, ...) plus
+# calendar columns, the small intermediate every calendar granularity is
+# derived from. Rows are put in (device, time) order (a no-op for the sorted
+# health frame and its DeviceTimeIndex slices) so each statistic is one
+# ufunc.reduceat over contiguous runs instead of a hash groupby.
+def rollup_health_frame(df):
+    ts = pd.DatetimeIndex(df["timestamp"])
+    keep = ~ts.isna()
+    hour = int(np.timedelta64(1, "h") // np.timedelta64(1, ts.unit))  # in the frame's own unit, no conversion
+    buckets = ts.asi8[keep] // hour
+    devices = df["device_id_id"].to_numpy()[keep]
+    same_device = devices[1:] == devices[:-1]
+    in_order = np.all((devices[1:] > devices[:-1]) | (same_device & (buckets[1:] >= buckets[:-1])))
+    order = None if in_order else np.lexsort((buckets, devices))
+    if order is not None:
+        buckets, devices = buckets[order], devices[order]
+        same_device = devices[1:] == devices[:-1]
+    starts = np.flatnonzero(np.r_[True, (buckets[1:] != buckets[:-1]) | ~same_device]) if len(buckets) else np.empty(0, dtype=np.intp)
+
+    hourly = {"device_id_id": devices[starts],
+              "hour_bucket": pd.DatetimeIndex((buckets[starts] * hour).view(f"datetime64[{ts.unit}]")).tz_localize("UTC")}
+    run_lengths = np.diff(np.r_[starts, len(buckets)])
+    for metric in HEALTH_METRICS:
+        values = df[metric].to_numpy(dtype=float)[keep]
+        if order is not None:
+            values = values[order]
+        if not len(starts):
+            for stat in ("sum", "count", "min", "max"):
+                hourly[f"{metric}_{stat}"] = np.empty(0)
+        elif np.isnan(values).any():
+            present = ~np.isnan(values)
+            hourly[f"{metric}_sum"] = np.add.reduceat(np.where(present, values, 0.0), starts)
+            hourly[f"{metric}_count"] = np.add.reduceat(present.astype(np.int64), starts)
+            hourly[f"{metric}_min"] = np.fmin.reduceat(values, starts)
+            hourly[f"{metric}_max"] = np.fmax.reduceat(values, starts)
+        else:
+            hourly[f"{metric}_sum"] = np.add.reduceat(values, starts)
+            hourly[f"{metric}_count"] = run_lengths
+            hourly[f"{metric}_min"] = np.minimum.reduceat(values, starts)
+            hourly[f"{metric}_max"] = np.maximum.reduceat(values, starts)
+    return add_calendar_columns(pd.DataFrame(hourly), "hour_bucket", date=False)
+
+
+HEALTH_SUM_COLUMNS = [f"{m}_{stat}" for m in HEALTH_METRICS for stat in ("sum", "count")]
+
+
+# Hourly health rollups of every device in one pass, plus the fleet partition
+def health_hourly_rollups(df):
+    return with_fleet_partition(rollup_health_frame(df), "hour_bucket", HEALTH_SUM_COLUMNS,
+                                [f"{m}_min" for m in HEALTH_METRICS], [f"{m}_max" for m in HEALTH_METRICS])
+
+
+# Mean of every health metric per `key` (year, month, weekday or hour) from the hourly rollup
+def health_means(hourly, key):
+    return health_means_from_sums(hourly.groupby(key)[HEALTH_SUM_COLUMNS].sum(), key)
+
+
+# Same from sums / counts already totalled per key (indexed by the key)
+def health_means_from_sums(totals, key):
+    totals = totals.sort_index()
+    means = pd.DataFrame({key: totals.index.astype("int64")})
+    for metric in HEALTH_METRICS:
+        means[metric] = (totals[f"{metric}_sum"] / totals[f"{metric}_count"]).to_numpy()
+    return means.round(2)
+
+
+# Range-maximum queries over one column: a sparse table over the maxima of
+# fixed-size blocks answers max(values[lo:hi]) with two table lookups plus at
+# most two partial blocks, in n / block * log(n / block) extra memory. NaN
+# values are never a maximum.
+class RangeMax:
+    def __init__(self, values, block=64):
+        self.block = block
+        self.values = np.where(np.isnan(values), -np.inf, values)
+        blocks = -(-len(values) // block)
+        padded = np.full(blocks * block, -np.inf)
+        padded[:len(values)] = self.values
+        level = padded.reshape(blocks, block).max(axis=1) if blocks else padded
+        self.levels, width = [level], 1
+        while 2 * width <= blocks:
+            level = np.maximum(level[:-width], level[width:])
+            self.levels.append(level)
+            width *= 2
+
+    # Largest value in values[lo:hi] (-inf if the range is empty or all NaN)
+    def max(self, lo, hi):
+        if hi <= lo:
+            return -np.inf
+        first_block, last_block = -(-lo // self.block), hi // self.block
+        if first_block >= last_block:
+            return self.values[lo:hi].max()
+        k = int(last_block - first_block).bit_length() - 1
+        best = max(self.levels[k][first_block], self.levels[k][last_block - (1 << k)])
+        if lo < first_block * self.block:
+            best = max(best, self.values[lo:first_block * self.block].max())
+        if last_block * self.block < hi:
+            best = max(best, self.values[last_block * self.block:hi].max())
+        return best
+
+
+# Bounded top-k per day of one column of a (device, time) sorted frame: for
+# every device-day only the k highest rows (ties: the most recent) are kept,
+# at most k * days positions in all. A range query merges the lists of the
+# days it covers with a k-bounded heap (O(m log k) for m candidates); the
+# partial days at either end of the range are read directly.
+class DailyTopK:
+    def __init__(self, values, ts, devices, k=10):
+        self.k = k
+        self.values = np.where(np.isnan(values), -np.inf, values)
+        day = np.where(ts == np.iinfo(np.int64).min, -1, ts // DAY_NS)  # NaT rows form days of their own
+        new_day = np.r_[True, (day[1:] != day[:-1]) | (devices[1:] != devices[:-1])] if len(day) else np.empty(0, dtype=bool)
+        self.day_starts = np.flatnonzero(new_day)
+        self.day_ends = np.r_[self.day_starts[1:], len(day)]
+        group = np.cumsum(new_day) - 1
+        order = np.lexsort((np.arange(len(day)), self.values, group))  # per day, ascending by (value, position)
+        rank_from_end = self.day_ends[group[order]] - 1 - np.arange(len(order))  # 0 = the day's top row
+        self.top = order[rank_from_end < k]
+        self.top_starts = np.searchsorted(group[self.top], np.arange(len(self.day_starts) + 1))
+
+    # Up to k positions in [lo, hi) holding `value`, the most recent ones, ascending
+    def recent_at(self, lo, hi, value):
+        if hi <= lo or value == -np.inf:
+            return np.empty(0, dtype=np.intp)
+        first = np.searchsorted(self.day_starts, lo, side="left")  # first day starting in range
+        end = np.searchsorted(self.day_ends, hi, side="right")  # days before `end` finish in range
+        if first >= end:  # no whole day: at most two partial days, read them
+            candidates = lo + np.flatnonzero(self.values[lo:hi] == value)
+        else:
+            head_end, tail_start = self.day_starts[first], self.day_ends[end - 1]
+            tops = self.top[self.top_starts[first]:self.top_starts[end]]
+            candidates = np.concatenate([
+                lo + np.flatnonzero(self.values[lo:head_end] == value),
+                tops[self.values[tops] == value],
+                tail_start + np.flatnonzero(self.values[tail_start:hi] == value),
+            ])
+        return np.array(sorted(heapq.nlargest(self.k, candidates.tolist())), dtype=np.intp)
+
+
+# Add rollups together (same device and hour bucket are summed, the result
+# stays sorted by device and hour bucket)
+def merge_rollups(*rollups):
+    combined = pd.concat(rollups, ignore_index=True)
+    return combined.groupby(["device_id_id", "hour_bucket"], as_index=False)[ROLLUP_COLUMNS].sum()
+
+
+# Read the tag CSV chunksize rows at a time, yielding the valid rows of each
+# chunk with payloads decoded and json_timestamp parsed (no calendar columns).
+# Only the first `size` bytes are read, by default the complete lines.
+def iter_tag_chunks(path, chunksize=200000, size=None):
+    with open_complete_lines(path, complete_size(path) if size is None else size) as f:
+        for chunk in _read_tag_csv(f, chunksize=chunksize):
+            chunk = _compact_device_ids(chunk)
+            decoded = decode_json_payloads(chunk["json_1"])
+            chunk[decoded.columns] = decoded
+            chunk["json_timestamp"] = parse_payload_timestamps(chunk["payload_timestamp"])
+            chunk["payload_error"] = validate_tag_payloads(chunk)
+            yield chunk[chunk["payload_error"].isna()]
+
+
+# Streaming path for exports larger than RAM: keep only the hourly rollups
+# and distinct-count sketches (see tag_distinct_sketches) of each chunk, so
+# peak memory is one chunk plus those. The rollups' sessions are distinct per
+# chunk, a session split over a chunk boundary is counted in both chunks;
+# the merged sketches count it once.
+def stream_tag_rollups(path, chunksize=200000):
+    size = complete_size(path)
+    partials, distinct, last_id, rows = [], None, -1, 0
+    for chunk in iter_tag_chunks(path, chunksize, size):
+        partials.append(rollup_tag_frame(chunk))
+        sketches = tag_distinct_sketches(chunk)
+        distinct = sketches if distinct is None else merge_tag_distinct_sketches(distinct, sketches)
+        if len(partials) > 16:
+            partials = [merge_rollups(*partials)]
+        last_id = max(last_id, chunk["id"].max())
+        rows += len(chunk)
+    if partials:
+        rollups = merge_rollups(*partials)
+    else:
+        rollups = pd.DataFrame({"device_id_id": pd.Series(dtype="int64"), "hour_bucket": pd.Series(dtype="datetime64[ns, UTC]"),
+                                **{c: pd.Series(dtype="int64") for c in ROLLUP_COLUMNS}})
+    if distinct is None:
+        distinct = empty_tag_distinct_sketches()
+    rollups.attrs.update(source_size=size, last_id=last_id)
+    print(f"tag rollups: {rows} rows -> {len(rollups)} device-hours, rss {resident_memory_mb():.1f} MB")
+    return rollups, distinct
+
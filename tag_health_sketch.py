@@ -0,0 +1,287 @@
+import itertools, math, os
+import numpy as np
+import pandas as pd
+
+HOUR_NS = 3600 * 10**9
+SPARSE_PRECISION = 25  # index bits of a sparse entry
+RANK_BITS = 6
+ENTRY_BITS = SPARSE_PRECISION + RANK_BITS
+
+
+# Number of significant bits of every value of an integer array, values
+# below 2 ** 53 (exact as float64, whose exponent is the bit length)
+def bit_length(values):
+    return np.frexp(values.astype(np.float64))[1]
+
+
+# {device: (first, last) positions} of arrays sorted by device
+def device_offsets(devices):
+    if not len(devices):
+        return {}
+    starts = np.flatnonzero(np.r_[True, devices[1:] != devices[:-1]])
+    return dict(zip(devices[starts].tolist(), zip(starts.tolist(), np.r_[starts[1:], len(devices)].tolist())))
+
+
+# Position ranges of the hour buckets start <= hour <= end of `devices` (None
+# for all) in a sketch sorted by (device, hour)
+def hour_slices(sketch, devices, start, end):
+    first, last = -(-pd.Timestamp(start).value // HOUR_NS), pd.Timestamp(end).value // HOUR_NS
+    slices = []
+    for device in sketch.offsets if devices is None else devices:
+        lo, hi = sketch.offsets.get(device, (0, 0))
+        hours = sketch.hours[lo:hi]
+        slices.append((lo + int(np.searchsorted(hours, first, side="left")), lo + int(np.searchsorted(hours, last, side="right"))))
+    return slices
+
+
+# Sort (device, hour, value) triples, value a uint64 below 2 ** value_bits.
+# Device rank, hour offset and value are packed into one uint64 sort key when
+# they fit (any fleet size over years of hours), a lexsort otherwise.
+def sort_device_hours(devices, hours, values, value_bits):
+    codes, uniques = pd.factorize(devices, sort=True)
+    first_hour = int(hours.min()) if len(hours) else 0
+    hour_bits = int(hours.max() - first_hour).bit_length() if len(hours) else 0
+    if int(len(uniques)).bit_length() + hour_bits + value_bits > 64:
+        order = np.lexsort((values, hours, devices))
+        return devices[order], hours[order], values[order]
+    key = np.sort((codes.astype(np.uint64) << np.uint64(hour_bits + value_bits))
+                  | ((hours - first_hour).astype(np.uint64) << np.uint64(value_bits)) | values.astype(np.uint64))
+    return (uniques[(key >> np.uint64(hour_bits + value_bits)).astype(np.intp)],
+            ((key >> np.uint64(value_bits)) & np.uint64((1 << hour_bits) - 1)).astype(np.int64) + first_hour,
+            key & np.uint64((1 << value_bits) - 1))
+
+
+# HyperLogLog precision (log2 of the register count) whose standard error,
+# 1.04 / sqrt(2 ** p), is at most `error`
+def hll_precision(error):
+    return min(max(math.ceil(math.log2((1.04 / error) ** 2)), 4), SPARSE_PRECISION - 7)
+
+
+# Distinct-count sketches of one column per (device, hour), in the sparse
+# HyperLogLog++ encoding: each distinct value is hashed to 64 bits and kept
+# as one uint32 entry, the top SPARSE_PRECISION hash bits (the index) plus
+# the rank (1 + leading zeros) of the remaining bits; per (device, hour) and
+# index only the highest rank is kept. Sketches of any set of hours and
+# devices merge by concatenating their entries, so a range is answered from
+# the entries of its device-hours instead of the raw rows, at any precision
+# up to SPARSE_PRECISION picked at query time. Entries are sorted by
+# (device, hour, entry).
+class DistinctSketches:
+    def __init__(self, devices, hours, entries):
+        self.devices, self.hours, self.entries = devices, hours, entries
+        self.offsets = device_offsets(devices)
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Entries of the hours start <= hour bucket <= end of `devices` (None for all)
+    def select(self, devices, start, end):
+        return np.concatenate([self.entries[lo:hi] for lo, hi in hour_slices(self, devices, start, end)] or
+                              [np.empty(0, dtype=np.uint32)])
+
+    # Estimated number of distinct values in the range. With at most
+    # `exact_limit` entries in range (or exact=True) the distinct sparse
+    # indexes are counted, which is exact up to hash collisions among the
+    # 2 ** SPARSE_PRECISION indexes (corrected by linear counting); otherwise
+    # the entries are folded into HyperLogLog registers sized for `error`.
+    def count(self, devices, start, end, error=0.01, exact_limit=1 << 16, exact=None):
+        entries = self.select(devices, start, end)
+        if exact or (exact is None and len(entries) <= exact_limit):
+            return _linear_count(len(np.unique(entries >> RANK_BITS)), 1 << SPARSE_PRECISION)
+        return _hll_estimate(_registers(entries, hll_precision(error)))
+
+
+def _linear_count(occupied, m):
+    return int(round(m * math.log(m / (m - occupied)))) if occupied < m else m
+
+
+# HyperLogLog registers at precision p from sparse entries
+def _registers(entries, p):
+    index = entries >> RANK_BITS
+    low_bits = SPARSE_PRECISION - p
+    low = (index & ((1 << low_bits) - 1)).astype(np.uint64)
+    # the rank at precision p counts the zeros of the index bits p does not use
+    rank = np.where(low > 0, low_bits - bit_length(low) + 1, low_bits + (entries & ((1 << RANK_BITS) - 1)))
+    registers = np.zeros(1 << p, dtype=np.uint8)
+    np.maximum.at(registers, index >> low_bits, rank.astype(np.uint8))
+    return registers
+
+
+def _hll_estimate(registers):
+    m = len(registers)
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+    estimate = alpha * m * m / np.ldexp(1.0, -registers.astype(np.int64)).sum()
+    zeros = int((registers == 0).sum())
+    if estimate <= 2.5 * m and zeros:
+        return _linear_count(m - zeros, m)
+    return int(round(estimate))
+
+
+# Sort entries by (device, hour, entry) and keep the highest rank per index
+def _compact(devices, hours, entries):
+    devices, hours, entries = sort_device_hours(devices, hours, entries, ENTRY_BITS)
+    entries = entries.astype(np.uint32)
+    if not len(entries):
+        return DistinctSketches(devices, hours, entries)
+    index = entries >> RANK_BITS
+    last = np.r_[(devices[1:] != devices[:-1]) | (hours[1:] != hours[:-1]) | (index[1:] != index[:-1]), True]
+    return DistinctSketches(devices[last], hours[last], entries[last])
+
+
+# Sketches of `values` (NaN / None skipped) observed by `devices` at `timestamps`
+def distinct_sketches(devices, timestamps, values):
+    ts = pd.DatetimeIndex(timestamps)
+    keep = ~(pd.isna(values) | ts.isna())
+    hashes = pd.util.hash_array(np.asarray(values)[keep])
+    rest_bits = 64 - SPARSE_PRECISION
+    rank = rest_bits + 1 - bit_length(hashes & np.uint64((1 << rest_bits) - 1))
+    entries = ((hashes >> np.uint64(rest_bits)) << np.uint64(RANK_BITS) | rank.astype(np.uint64)).astype(np.uint32)
+    return _compact(np.asarray(devices)[keep].astype(np.int64), ts.as_unit("ns").asi8[keep] // HOUR_NS, entries)
+
+
+def merge_distinct_sketches(*sketches):
+    return _compact(*(np.concatenate([getattr(s, name) for s in sketches]) for name in ("devices", "hours", "entries")))
+
+
+# Distinct sessions (int_1) and distinct tag ids of a derived tag frame, per (device, hour)
+def tag_distinct_sketches(df):
+    sessions = df["int_1"].to_numpy(dtype=float, na_value=np.nan)  # one hash per id, whatever the column dtype
+    lengths = df["tag_count"].to_numpy()
+    pos = np.repeat(np.arange(len(df)), lengths)
+    tag_lists = df["tag_list"].tolist()
+    if len(pos) and isinstance(tag_lists[0], np.ndarray):
+        tags = np.concatenate(tag_lists).astype(object)  # arrays as read back from the parquet cache
+    else:
+        tags = np.fromiter(itertools.chain.from_iterable(tag_lists), dtype=object, count=len(pos))
+    return {
+        "sessions": distinct_sketches(df["device_id_id"].to_numpy(), df["json_timestamp"], sessions),
+        "tags": distinct_sketches(df["device_id_id"].to_numpy()[pos], df["json_timestamp"].array.take(pos), tags),
+    }
+
+
+def empty_tag_distinct_sketches():
+    return {name: DistinctSketches(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32))
+            for name in ("sessions", "tags")}
+
+
+def merge_tag_distinct_sketches(a, b):
+    return {name: merge_distinct_sketches(a[name], b[name]) for name in a}
+
+
+# Tag distinct sketches saved to one .npz file (replaced atomically)
+def save_tag_distinct_sketches(path, distinct):
+    arrays = {f"{name}_{field}": getattr(sketches, field)
+              for name, sketches in distinct.items() for field in ("devices", "hours", "entries")}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+# The sketches save_tag_distinct_sketches wrote, None if there is no file
+def load_tag_distinct_sketches(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        return {name: DistinctSketches(saved[f"{name}_devices"], saved[f"{name}_hours"], saved[f"{name}_entries"])
+                for name in ("sessions", "tags")}
+
+
+QUANTILE_ACCURACY = 0.01
+BIN_EXPONENT = 2047  # bins cover magnitudes gamma ** -2047 .. gamma ** 2047
+BIN_BITS = 13
+
+
+# Mergeable quantile sketches of one numeric column per (device, hour), as
+# in DDSketch: a value v is counted in the log-spaced bin of
+# ceil(log_gamma(|v|)), gamma = (1 + a) / (1 - a), signed for negative values
+# (magnitudes below gamma ** -BIN_EXPONENT count as 0). Reading a quantile
+# back from its bin is within relative error a of the exact order
+# statistic, and sketches of any hours / devices merge by adding bin counts,
+# so percentiles of a range come from the bins of its device-hours instead
+# of sorting the raw samples. Bins are stored sparsely, sorted by (device,
+# hour, bin).
+class QuantileSketches:
+    def __init__(self, devices, hours, bins, counts, accuracy=QUANTILE_ACCURACY):
+        self.devices, self.hours, self.bins, self.counts = devices, hours, bins, counts
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.offsets = device_offsets(devices)
+
+    def __len__(self):
+        return len(self.bins)
+
+    # Quantiles `qs` of the values in the range per calendar key `by`
+    # ("hour", "weekday", "month" or "year", in UTC), one row per key with
+    # values and columns p50, p90, ... (percent of each q)
+    def quantiles(self, devices, start, end, by, qs=(0.5, 0.9, 0.99)):
+        slices = hour_slices(self, devices, start, end)
+        hours, bins, counts = (np.concatenate([a[lo:hi] for lo, hi in slices] or [a[:0]])
+                               for a in (self.hours, self.bins, self.counts))
+        out = pd.DataFrame({by: pd.Series(dtype="int64"), **{f"p{round(q * 100)}": pd.Series(dtype=float) for q in qs}})
+        if not len(bins):
+            return out
+        keys = calendar_keys(hours, by)
+        first_key, first_bin = keys.min(), int(bins.min())
+        shape = (keys.max() - first_key + 1, int(bins.max()) - first_bin + 1)
+        cells = (keys - first_key) * shape[1] + (bins - first_bin)
+        grid = np.bincount(cells, weights=counts, minlength=shape[0] * shape[1]).reshape(shape)
+        present = np.flatnonzero(grid.sum(axis=1))
+        cumulative = grid[present].cumsum(axis=1)
+        out = pd.DataFrame({by: present + first_key})
+        for q in qs:
+            rank = np.floor(q * (cumulative[:, -1] - 1))  # lower order statistic, as 0-based rank
+            out[f"p{round(q * 100)}"] = self.bin_values((cumulative <= rank[:, None]).sum(axis=1) + first_bin)
+        return out
+
+    # Representative value of each bin (the middle of its value interval)
+    def bin_values(self, bins):
+        signed = bins.astype(np.int64) - (1 << (BIN_BITS - 1))
+        exponent = np.abs(signed) - BIN_EXPONENT - 1
+        return np.where(signed == 0, 0.0, np.sign(signed) * 2 * self.gamma ** exponent / (self.gamma + 1))
+
+
+# Calendar key of hour buckets (hours since the epoch, UTC)
+def calendar_keys(hours, by):
+    if by == "hour":
+        return hours % 24
+    if by == "weekday":
+        return (hours // 24 + 3) % 7  # 1970-01-01 was a Thursday, Monday = 0
+    months = hours.astype("datetime64[h]").astype("datetime64[M]").astype(np.int64)
+    return months % 12 + 1 if by == "month" else months // 12 + 1970
+
+
+# Sketch of `values` (NaN skipped) observed by `devices` at `timestamps`
+def quantile_sketches(devices, timestamps, values, accuracy=QUANTILE_ACCURACY):
+    ts = pd.DatetimeIndex(timestamps)
+    values = np.asarray(values, dtype=float)
+    keep = ~(np.isnan(values) | ts.isna())
+    values = values[keep]
+    gamma = (1 + accuracy) / (1 - accuracy)
+    with np.errstate(divide="ignore"):
+        exponent = np.ceil(np.log(np.abs(values)) / math.log(gamma))
+    magnitude = np.where(exponent < -BIN_EXPONENT, 0, np.minimum(exponent, BIN_EXPONENT) + BIN_EXPONENT + 1)
+    bins = (np.sign(values) * magnitude).astype(np.int64) + (1 << (BIN_BITS - 1))
+    devices, hours, bins = sort_device_hours(np.asarray(devices)[keep].astype(np.int64),
+                                             ts.as_unit("ns").asi8[keep] // HOUR_NS, bins, BIN_BITS)
+    if not len(bins):
+        return QuantileSketches(devices, hours, bins.astype(np.int16), np.empty(0, dtype=np.int64), accuracy)
+    starts = np.flatnonzero(np.r_[True, (devices[1:] != devices[:-1]) | (hours[1:] != hours[:-1]) | (bins[1:] != bins[:-1])])
+    counts = np.diff(np.r_[starts, len(bins)])
+    return QuantileSketches(devices[starts], hours[starts], bins[starts].astype(np.int16), counts, accuracy)
+
+
+
+# Quantile sketches of every health metric column of a health frame
+def health_quantile_sketches(df, metrics):
+    return {metric: quantile_sketches(df["device_id_id"].to_numpy(), df["timestamp"], df[metric].to_numpy(dtype=float))
+            for metric in metrics}
+
+
+# p50 / p90 / p99 of every metric per calendar key `by` in the range, as
+# one frame with columns <metric>_p50, ... (keys without any value are left out)
+def health_percentiles(quantiles, devices, start, end, by):
+    merged = None
+    for metric, sketches in quantiles.items():
+        frame = sketches.quantiles(devices, start, end, by).set_index(by).add_prefix(f"{metric}_")
+        merged = frame if merged is None else merged.join(frame, how="outer")
+    return merged.sort_index().round(2).reset_index()
@@ -0,0 +1,274 @@
+import json, os, shutil, sqlite3
+import numpy as np
+import pandas as pd
+from tag_health_loader import iter_tag_chunks, complete_size
+from tag_health_sketch import (tag_distinct_sketches, merge_tag_distinct_sketches, empty_tag_distinct_sketches,
+                               save_tag_distinct_sketches, load_tag_distinct_sketches)
+
+
+# One fixed-width record per reader session row (29 bytes):
+# payload timestamp (ns since epoch, UTC), device, session (int_1), status, tag reads
+SESSION_DTYPE = np.dtype([
+    ("timestamp", "<i8"),
+    ("device", "<i4"),
+    ("session", "<i8"),
+    ("status", "i1"),
+    ("reads", "<i8"),
+])
+STATUS_CODES = {"success": 1, "failed": 2}  # anything else is 0
+STATUS_NAMES = np.array([None, "success", "failed"], dtype=object)
+
+
+# Session records of a derived tag frame (rows without a payload timestamp are skipped)
+def session_records(df):
+    df = df[df["json_timestamp"].notna()]
+    records = np.empty(len(df), dtype=SESSION_DTYPE)
+    records["timestamp"] = pd.DatetimeIndex(df["json_timestamp"]).as_unit("ns").asi8
+    records["device"] = df["device_id_id"].to_numpy()
+    records["session"] = df["int_1"].fillna(-1).to_numpy()
+    records["status"] = df["char_1"].astype(object).map(STATUS_CODES).fillna(0).to_numpy()
+    records["reads"] = df["tag_reads"].to_numpy()
+    return records
+
+
+# Distinct session / tag sketches of a store's rows (see DistinctSketches),
+# saved next to it: empty for a new store, None for a store filled before
+# they were kept (see sketch_stored_rows)
+def open_store_sketches(store):
+    distinct = load_tag_distinct_sketches(store.sketch_path)
+    if distinct is None and len(store) == 0:
+        distinct = empty_tag_distinct_sketches()
+    return distinct
+
+
+def add_store_sketches(store, df):
+    if store.distinct is not None:
+        store.distinct = merge_tag_distinct_sketches(store.distinct, tag_distinct_sketches(df))
+
+
+# Binary store of session records that is opened with np.memmap, so a
+# date-range query only pages in the records it returns. The file is kept
+# sorted by timestamp, so a query is two binary searches on the mapped
+# timestamps: a batch in time order is appended, a batch older than the last
+# stored record is merged into place (see append). A store left unsorted by
+# an earlier version is compacted when it is opened; until then queries fall
+# back to a blockwise scan of the file.
+class SessionStore:
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = path + ".json"
+        self.sketch_path = path + ".sketches.npz"
+        self.meta = {"sorted": True}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        if not self.meta["sorted"]:
+            self.compact()
+        if "devices" not in self.meta:  # a store written before the device set was kept
+            self.meta["devices"] = np.unique(self.records()["device"]).tolist()
+        self.distinct = open_store_sketches(self)
+
+    def __len__(self):
+        # a record that is still being written is ignored
+        return os.path.getsize(self.path) // SESSION_DTYPE.itemsize if os.path.exists(self.path) else 0
+
+    def records(self):
+        n = len(self)
+        if n == 0:
+            return np.empty(0, dtype=SESSION_DTYPE)
+        return np.memmap(self.path, dtype=SESSION_DTYPE, mode="r", shape=(n,))
+
+    def append(self, df):
+        add_store_sketches(self, df)
+        batch = np.sort(session_records(df), order="timestamp", kind="stable")
+        if len(batch) == 0:
+            return 0
+        self.meta["devices"] = sorted(set(self.meta["devices"]).union(np.unique(batch["device"]).tolist()))
+        existing = self.records()
+        if len(existing) and batch["timestamp"][0] < existing["timestamp"][-1] and self.meta["sorted"]:
+            self._merge(existing, batch)
+        else:
+            with open(self.path, "ab") as f:
+                f.write(batch.tobytes())
+        return len(batch)
+
+    # Merge a batch that starts before the last stored record into place:
+    # only the stored records after the batch's first timestamp are re-sorted
+    # with it, into a copy of the file that replaces the original, so open
+    # memmaps keep seeing the old, whole file.
+    def _merge(self, existing, batch):
+        pos = np.searchsorted(existing["timestamp"], batch["timestamp"][0], side="right")
+        tail = np.sort(np.concatenate([existing[pos:], batch]), order="timestamp", kind="stable")
+        tmp_path = self.path + ".tmp"
+        shutil.copyfile(self.path, tmp_path)
+        with open(tmp_path, "r+b") as f:
+            f.seek(pos * SESSION_DTYPE.itemsize)
+            f.write(tail.tobytes())
+        os.replace(tmp_path, self.path)
+
+    # Remember how far into the source export the store has ingested (and
+    # the devices seen so far)
+    def mark_ingested(self, source_size, last_id):
+        if self.distinct is not None:
+            save_tag_distinct_sketches(self.sketch_path, self.distinct)
+        self.meta.update(source_size=int(source_size), last_id=int(last_id))
+        self._write_meta()
+
+    # Oldest and newest stored timestamp
+    def time_range(self):
+        ts = self.records()["timestamp"]
+        if len(ts) == 0:
+            return pd.NaT, pd.NaT
+        lo, hi = (ts[0], ts[-1]) if self.meta["sorted"] else (ts.min(), ts.max())
+        return pd.Timestamp(lo, unit="ns", tz="UTC"), pd.Timestamp(hi, unit="ns", tz="UTC")
+
+    # Ids of the devices that have records, ascending
+    def devices(self):
+        return list(self.meta["devices"])
+
+    # Rewrite the file in timestamp order (after out-of-order appends)
+    def compact(self):
+        records = np.sort(np.array(self.records()), order="timestamp", kind="stable")
+        tmp_path = self.path + ".tmp"
+        records.tofile(tmp_path)
+        os.replace(tmp_path, self.path)
+        self.meta["sorted"] = True
+        self._write_meta()
+
+    def _write_meta(self):
+        with open(self.meta_path, "w") as f:
+            json.dump(self.meta, f)
+
+    # Records with start_dt <= timestamp <= end_dt (optionally one device),
+    # as a frame with the tag frame's column names.
+    def query(self, start_dt, end_dt, device=None, block=1 << 20):
+        records = self.records()
+        start_ns, end_ns = pd.Timestamp(start_dt).value, pd.Timestamp(end_dt).value
+        if self.meta["sorted"]:
+            lo = np.searchsorted(records["timestamp"], start_ns, side="left")
+            hi = np.searchsorted(records["timestamp"], end_ns, side="right")
+            page = np.array(records[lo:hi])
+        else:
+            parts = []
+            for pos in range(0, len(records), block):
+                part = records[pos:pos + block]
+                parts.append(np.array(part[(part["timestamp"] >= start_ns) & (part["timestamp"] <= end_ns)]))
+            page = np.concatenate(parts) if parts else np.empty(0, dtype=SESSION_DTYPE)
+        if device is not None:
+            page = page[page["device"] == device]
+        return pd.DataFrame({
+            "json_timestamp": pd.to_datetime(page["timestamp"], unit="ns", utc=True),
+            "device_id_id": page["device"],
+            "int_1": page["session"],
+            "char_1": pd.Categorical(STATUS_NAMES[page["status"]]),
+            "reads": page["reads"],
+        })
+
+
+# Same interface as SessionStore backed by an embedded SQLite database, with
+# indexes on (device_id_id, json_timestamp), on json_timestamp (the
+# all-devices queries) and on int_1 so the callbacks' range queries only
+# read the rows they return. One connection per call,
+# since Dash serves callbacks from several threads.
+class SqliteTagStore:
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as con:
+            con.executescript("""
+                CREATE TABLE IF NOT EXISTS tag_sessions (
+                    id INTEGER PRIMARY KEY,
+                    device_id_id INTEGER NOT NULL,
+                    json_timestamp INTEGER NOT NULL,  -- ns since epoch, UTC
+                    int_1 INTEGER,
+                    char_1 TEXT,
+                    reads INTEGER NOT NULL,
+                    json_1 TEXT
+                );
+                CREATE INDEX IF NOT EXISTS ix_tag_sessions_device_ts ON tag_sessions (device_id_id, json_timestamp);
+                CREATE INDEX IF NOT EXISTS ix_tag_sessions_ts ON tag_sessions (json_timestamp);
+                CREATE INDEX IF NOT EXISTS ix_tag_sessions_int_1 ON tag_sessions (int_1);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+            """)
+            self.meta = dict(con.execute("SELECT key, value FROM meta").fetchall())
+        self.sketch_path = path + ".sketches.npz"
+        self.distinct = open_store_sketches(self)
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def __len__(self):
+        with self._connect() as con:
+            return con.execute("SELECT COUNT(*) FROM tag_sessions").fetchone()[0]
+
+    # Rows already stored (same id) are skipped
+    def append(self, df):
+        df = df[df["json_timestamp"].notna()]
+        add_store_sketches(self, df)
+        rows = zip(
+            df["id"].tolist(),
+            df["device_id_id"].tolist(),
+            pd.DatetimeIndex(df["json_timestamp"]).as_unit("ns").asi8.tolist(),
+            df["int_1"].astype(object).where(df["int_1"].notna(), None).tolist(),
+            df["char_1"].astype(object).where(df["char_1"].notna(), None).tolist(),
+            df["tag_reads"].tolist(),
+            [json.dumps(js) for js in df["json_1"]],
+        )
+        with self._connect() as con:
+            before = con.total_changes
+            con.executemany("INSERT OR IGNORE INTO tag_sessions VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            return con.total_changes - before
+
+    def mark_ingested(self, source_size, last_id):
+        if self.distinct is not None:
+            save_tag_distinct_sketches(self.sketch_path, self.distinct)
+        self.meta.update(source_size=int(source_size), last_id=int(last_id))
+        with self._connect() as con:
+            con.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", self.meta.items())
+
+    def time_range(self):
+        with self._connect() as con:
+            lo, hi = con.execute("SELECT MIN(json_timestamp), MAX(json_timestamp) FROM tag_sessions").fetchone()
+        if lo is None:
+            return pd.NaT, pd.NaT
+        return pd.Timestamp(lo, unit="ns", tz="UTC"), pd.Timestamp(hi, unit="ns", tz="UTC")
+
+    def devices(self):
+        with self._connect() as con:
+            return [device for device, in con.execute("SELECT DISTINCT device_id_id FROM tag_sessions ORDER BY 1")]
+
+    def query(self, start_dt, end_dt, device=None):
+        sql = "SELECT json_timestamp, device_id_id, int_1, char_1, reads FROM tag_sessions WHERE json_timestamp BETWEEN ? AND ?"
+        params = [pd.Timestamp(start_dt).value, pd.Timestamp(end_dt).value]
+        if device is not None:
+            sql += " AND device_id_id = ?"
+            params.append(int(device))
+        with self._connect() as con:
+            page = pd.read_sql_query(sql, con, params=params)
+        page["json_timestamp"] = pd.to_datetime(page["json_timestamp"], unit="ns", utc=True)
+        page["char_1"] = page["char_1"].astype("category")
+        return page
+
+
+# Fill a store from a tag CSV chunk by chunk (bounded memory)
+def ingest_tag_csv(store, csv_path, chunksize=200000):
+    size = complete_size(csv_path)
+    last_id, rows = store.meta.get("last_id", -1), 0
+    for chunk in iter_tag_chunks(csv_path, chunksize, size):
+        chunk = chunk[chunk["id"] > last_id]
+        rows += store.append(chunk)
+        if len(chunk):
+            last_id = chunk["id"].max()
+    store.mark_ingested(size, last_id)
+    print(f"session store: ingested {rows} records into {store.path} ({len(store)} total)")
+    return store
+
+
+# Distinct sketches for a store filled before they were kept: one pass over
+# the rows of the export the store already holds
+def sketch_stored_rows(store, csv_path, chunksize=200000):
+    last_id, distinct = store.meta.get("last_id", -1), empty_tag_distinct_sketches()
+    for chunk in iter_tag_chunks(csv_path, chunksize):
+        distinct = merge_tag_distinct_sketches(distinct, tag_distinct_sketches(chunk[chunk["id"] <= last_id]))
+    store.distinct = distinct
+    save_tag_distinct_sketches(store.sketch_path, distinct)
+    return store
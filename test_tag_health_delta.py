@@ -0,0 +1,81 @@
+from functools import partial
+import numpy as np
+import pandas as pd
+import pytest
+from tag_health_loader import DeviceTimeIndex
+from tag_health_delta import DeltaRange, hourly_rows, DAY
+
+COLUMNS = ["reads", "sessions"]
+FIRST_DAY = pd.Timestamp("2025-01-01", tz="UTC")
+
+
+# Hourly rollups of one device over 90 days, about a third of the hours with rows
+def random_rollups(rng):
+    hours = np.sort(rng.choice(90 * 24, 700, replace=False))
+    return pd.DataFrame({
+        "device_id_id": 1,
+        "hour_bucket": FIRST_DAY + pd.to_timedelta(hours, unit="h"),
+        "reads": rng.integers(0, 50, len(hours)).astype(float),
+        "sessions": rng.integers(0, 5, len(hours)).astype(float),
+    })
+
+
+# Range totals per key straight from the rows in [first_day, last_day]
+def brute_frame(df, first_day, last_day, name):
+    rows = df[(df["hour_bucket"] >= first_day) & (df["hour_bucket"] < last_day + DAY)]
+    ts = rows["hour_bucket"].dt
+    keys = {"hour": [ts.hour], "weekday": [ts.dayofweek], "month": [ts.month], "year": [ts.year],
+            "year_month": [ts.year, ts.month], "day": [ts.floor("D")]}[name]
+    return rows[COLUMNS].assign(rows=1.0).groupby(keys).sum()
+
+
+# Date ranges as a picker scrub produces them: small moves, resizes and jumps
+def random_ranges(rng, count):
+    first, last = 10, 30
+    for _ in range(count):
+        move = rng.random()
+        if move < 0.5:
+            shift = int(rng.integers(-3, 4))
+            first, last = first + shift, last + shift
+        elif move < 0.8:
+            first, last = first + int(rng.integers(-3, 4)), last + int(rng.integers(-3, 4))
+        else:
+            first = int(rng.integers(0, 80))
+            last = first + int(rng.integers(0, 30))
+        first, last = min(max(first, 0), 89), min(max(last, 0), 89)
+        first, last = min(first, last), max(first, last)
+        yield FIRST_DAY + first * DAY, FIRST_DAY + last * DAY
+
+
+@pytest.mark.parametrize("full_every", [1, 4, 32])
+def test_delta_range_matches_brute_force(full_every):
+    rng = np.random.default_rng(full_every)
+    df = random_rollups(rng)
+    rollups = DeviceTimeIndex(df, "hour_bucket")
+    ranges = DeltaRange(rollups, partial(hourly_rows, rollups, COLUMNS, 1), COLUMNS, full_every=full_every)
+    for first_day, last_day in random_ranges(rng, 60):
+        totals = ranges.update(first_day, last_day)
+        for name in ["hour", "weekday", "month", "year", "year_month"]:
+            expected = brute_frame(df, first_day, last_day, name)
+            got = totals.frame(name)
+            assert got.index.tolist() == expected.index.tolist()
+            np.testing.assert_allclose(got.to_numpy(), expected.to_numpy())
+        expected = brute_frame(df, first_day, last_day, "day")
+        np.testing.assert_allclose(totals.daily().to_numpy(), expected.to_numpy())
+        rows = df[(df["hour_bucket"] >= first_day) & (df["hour_bucket"] < last_day + DAY)]
+        points = totals.hourly_points()
+        assert points.index.tolist() == rows["hour_bucket"].tolist()
+        np.testing.assert_allclose(points[COLUMNS].to_numpy(), rows[COLUMNS].to_numpy())
+        assert totals.rows() == len(rows)
+
+
+# A snapshot keeps the totals of its own update after the range moves on
+def test_range_totals_snapshot_is_stable():
+    df = random_rollups(np.random.default_rng(0))
+    rollups = DeviceTimeIndex(df, "hour_bucket")
+    ranges = DeltaRange(rollups, partial(hourly_rows, rollups, COLUMNS, 1), COLUMNS)
+    totals = ranges.update(FIRST_DAY + 10 * DAY, FIRST_DAY + 30 * DAY)
+    before = {name: totals.frame(name) for name in ["hour", "weekday", "year_month"]}
+    ranges.update(FIRST_DAY + 12 * DAY, FIRST_DAY + 35 * DAY)
+    for name, frame in before.items():
+        pd.testing.assert_frame_equal(totals.frame(name), frame)
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+from tag_health_loader import RangeMax, DailyTopK, DeviceTimeIndex, ALL_DEVICES, DAY_NS
+
+
+# Values with NaNs and many ties, so the partial-block and all-NaN cases come up
+def random_values(rng, n):
+    values = rng.integers(0, 20, n).astype(float)
+    values[rng.random(n) < 0.1] = np.nan
+    return values
+
+
+def brute_max(values, lo, hi):
+    window = values[lo:hi]
+    window = window[~np.isnan(window)]
+    return window.max() if len(window) else -np.inf
+
+
+@pytest.mark.parametrize("block", [1, 4, 64])
+def test_range_max_matches_brute_force(block):
+    rng = np.random.default_rng(block)
+    for n in (0, 1, 7, 300):
+        values = random_values(rng, n)
+        index = RangeMax(values, block=block)
+        for _ in range(300):
+            lo, hi = sorted(rng.integers(0, n + 1, 2))
+            assert index.max(lo, hi) == brute_max(values, lo, hi)
+
+
+def test_range_max_all_nan():
+    index = RangeMax(np.full(10, np.nan), block=4)
+    assert index.max(0, 10) == -np.inf
+
+
+# Rows sorted by device, then time: a few devices over a few days, several
+# rows per day, so whole and partial days both come up in random ranges
+def random_device_days(rng, n):
+    devices = np.sort(rng.integers(1, 4, n))
+    ts = rng.integers(0, 6 * DAY_NS, n)
+    ts = ts[np.lexsort((ts, devices))]
+    return devices, ts, random_values(rng, n)
+
+
+def brute_recent_at(values, lo, hi, value, k):
+    return lo + np.flatnonzero(values[lo:hi] == value)[-k:]
+
+
+@pytest.mark.parametrize("k", [1, 3, 10])
+def test_daily_top_k_matches_brute_force(k):
+    rng = np.random.default_rng(k)
+    for n in (0, 5, 400):
+        devices, ts, values = random_device_days(rng, n)
+        top = DailyTopK(values, ts, devices, k=k)
+        for _ in range(300):
+            lo, hi = (int(i) for i in sorted(rng.integers(0, n + 1, 2)))
+            peak = brute_max(values, lo, hi)
+            assert top.recent_at(lo, hi, peak).tolist() == brute_recent_at(values, lo, hi, peak, k).tolist()
+
+
+# The peak KPI rows of one device and of the fleet against a scan of the frame
+def test_peak_rows_match_brute_force():
+    rng = np.random.default_rng(7)
+    devices, ts, values = random_device_days(rng, 500)
+    df = pd.DataFrame({"device_id_id": devices, "timestamp": pd.to_datetime(ts, utc=True), "cpu_usage": values})
+    index = DeviceTimeIndex(df, "timestamp", max_columns=["cpu_usage"], peak_k=4)
+    for _ in range(200):
+        start, end = sorted(pd.to_datetime(rng.integers(0, 6 * DAY_NS, 2), utc=True))
+        for device in (1, 2, 3, ALL_DEVICES):
+            rows = df[(df["timestamp"] >= start) & (df["timestamp"] <= end)]
+            if device != ALL_DEVICES:
+                rows = rows[rows["device_id_id"] == device]
+            peak = rows[rows["cpu_usage"] == rows["cpu_usage"].max()].sort_values("timestamp", kind="stable")
+            expected = peak.index[-4:].tolist()
+            assert index.peak_rows(device, start, end, "cpu_usage").index.tolist() == expected
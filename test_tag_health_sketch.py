@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import pytest
+from tag_health_sketch import (quantile_sketches, QUANTILE_ACCURACY, distinct_sketches, merge_distinct_sketches,
+                               tag_distinct_sketches)
+
+QS = (0.05, 0.5, 0.9, 0.99)
+FIRST_DAY = pd.Timestamp("2024-11-01", tz="UTC")
+
+
+# Readings of three devices over 120 days: magnitudes from 0.01 to 1e4,
+# some exact zeros, negatives and NaNs
+def random_samples(rng, n):
+    devices = rng.integers(1, 4, n)
+    ts = FIRST_DAY + pd.to_timedelta(rng.integers(0, 120 * 86400, n), unit="s")
+    values = np.round(10 ** rng.uniform(-2, 4, n), 2) * rng.choice([-1, 1], n, p=[0.2, 0.8])
+    values[rng.random(n) < 0.05] = 0
+    values[rng.random(n) < 0.05] = np.nan
+    return devices, pd.DatetimeIndex(ts), values
+
+
+# Lower order statistic q * (n - 1) of the values in range, per calendar key
+def brute_quantiles(devices, ts, values, wanted, start, end, by):
+    hours = ts.floor("h")
+    keep = (hours >= start) & (hours <= end) & ~np.isnan(values)
+    if wanted is not None:
+        keep &= np.isin(devices, wanted)
+    keys = {"hour": ts.hour, "weekday": ts.dayofweek, "month": ts.month, "year": ts.year}[by][keep]
+    out = {}
+    for key in np.unique(keys):
+        ordered = np.sort(values[keep][keys == key])
+        out[int(key)] = [ordered[int(np.floor(q * (len(ordered) - 1)))] for q in QS]
+    return out
+
+
+@pytest.mark.parametrize("by", ["hour", "weekday", "month", "year"])
+def test_quantiles_within_relative_accuracy(by):
+    rng = np.random.default_rng(len(by))
+    devices, ts, values = random_samples(rng, 20000)
+    sketches = quantile_sketches(devices, ts, values)
+    for _ in range(20):
+        first, days = int(rng.integers(0, 120)), int(rng.integers(1, 90))
+        start = FIRST_DAY + pd.Timedelta(days=first)
+        end = start + pd.Timedelta(days=days) - pd.Timedelta(seconds=1)
+        wanted = None if rng.random() < 0.3 else [int(rng.integers(1, 4))]
+        expected = brute_quantiles(devices, ts, values, wanted, start, end, by)
+        got = sketches.quantiles(wanted, start, end, by, qs=QS)
+        assert got[by].tolist() == sorted(expected)
+        for row in got.itertuples(index=False):
+            exact = np.array(expected[getattr(row, by)])
+            estimate = np.array(row[1:])
+            np.testing.assert_array_less(np.abs(estimate - exact), QUANTILE_ACCURACY * np.abs(exact) + 1e-9)
+
+
+def test_quantiles_of_an_empty_range():
+    devices, ts, values = random_samples(np.random.default_rng(0), 100)
+    sketches = quantile_sketches(devices, ts, values)
+    start = pd.Timestamp("2030-01-01", tz="UTC")
+    got = sketches.quantiles(None, start, start + pd.Timedelta(days=1), "hour", qs=QS)
+    assert got.empty and list(got.columns) == ["hour", "p5", "p50", "p90", "p99"]
+
+
+def test_quantiles_of_all_nan_values():
+    devices, ts, values = random_samples(np.random.default_rng(0), 100)
+    sketches = quantile_sketches(devices, ts, np.full(len(values), np.nan))
+    assert len(sketches) == 0
+    got = sketches.quantiles(None, FIRST_DAY, FIRST_DAY + pd.Timedelta(days=120), "hour", qs=QS)
+    assert got.empty and list(got.columns) == ["hour", "p5", "p50", "p90", "p99"]
+
+
+# Tag ids as strings, a few thousand per device, repeated across rows and devices
+def random_ids(rng, n):
+    devices, ts, _ = random_samples(rng, n)
+    ids = np.array([f"tag-{i}" for i in rng.integers(0, 4000, n)], dtype=object)
+    ids[rng.random(n) < 0.05] = None
+    return devices, ts, ids
+
+
+def brute_distinct(devices, ts, ids, wanted, start, end):
+    hours = ts.floor("h")
+    keep = (hours >= start) & (hours <= end)
+    if wanted is not None:
+        keep &= np.isin(devices, wanted)
+    return pd.Series(ids[keep]).nunique()
+
+
+@pytest.mark.parametrize("exact", [True, False])
+def test_distinct_counts_match_nunique(exact):
+    rng = np.random.default_rng(int(exact))
+    devices, ts, ids = random_ids(rng, 20000)
+    sketches = distinct_sketches(devices, ts, ids)
+    for _ in range(20):
+        start = FIRST_DAY + pd.Timedelta(days=int(rng.integers(0, 120)))
+        end = start + pd.Timedelta(days=int(rng.integers(1, 90))) - pd.Timedelta(seconds=1)
+        wanted = None if rng.random() < 0.3 else [int(rng.integers(1, 4))]
+        expected = brute_distinct(devices, ts, ids, wanted, start, end)
+        got = sketches.count(wanted, start, end, exact=exact)
+        # exact counts are off only by collisions among the sparse indexes;
+        # HyperLogLog at error=0.01 keeps well within 5%
+        assert abs(got - expected) <= (1 if exact else 0.05 * expected + 1)
+
+
+def test_merged_sketches_equal_sketches_of_all_rows():
+    devices, ts, ids = random_ids(np.random.default_rng(3), 5000)
+    whole = distinct_sketches(devices, ts, ids)
+    merged = merge_distinct_sketches(distinct_sketches(devices[:2000], ts[:2000], ids[:2000]),
+                                     distinct_sketches(devices[2000:], ts[2000:], ids[2000:]))
+    for name in ("devices", "hours", "entries"):
+        np.testing.assert_array_equal(getattr(merged, name), getattr(whole, name))
+
+
+def test_distinct_sketches_of_no_values():
+    devices, ts, ids = random_ids(np.random.default_rng(4), 100)
+    empty = distinct_sketches(devices[:0], ts[:0], ids[:0])
+    assert len(empty) == 0 and empty.count(None, FIRST_DAY, FIRST_DAY + pd.Timedelta(days=120)) == 0
+    assert len(distinct_sketches(devices, ts, np.full(len(ids), None))) == 0
+    whole = distinct_sketches(devices, ts, ids)
+    np.testing.assert_array_equal(merge_distinct_sketches(whole, empty).entries, whole.entries)
+
+
+# Rows without tags (an empty tag list), as the export has, give empty tag sketches
+def test_tag_sketches_of_rows_without_tags():
+    df = pd.DataFrame({
+        "device_id_id": [1, 1, 2],
+        "json_timestamp": pd.to_datetime(["2025-01-01 10:00", "2025-01-01 11:30", "2025-01-02 08:00"], utc=True),
+        "int_1": [7, 8, 7],
+        "tag_list": [[], [], []],
+        "tag_count": [0, 0, 0],
+    })
+    distinct = tag_distinct_sketches(df)
+    assert len(distinct["tags"]) == 0
+    assert distinct["sessions"].count(None, FIRST_DAY, FIRST_DAY + pd.Timedelta(days=120)) == 2
+    assert all(len(sketches) == 0 for sketches in tag_distinct_sketches(df.iloc[:0]).values())